@@ -3,7 +3,23 @@ from lark import Lark, exceptions
 from lark.lexer import Token
 from lark.tree import Tree
 from lark.visitors import Interpreter, Visitor
+from collections import OrderedDict
+from functools import reduce
+from itertools import islice
+import contextlib
+import copy
+import glob
+import io
 import math
+import operator
+import sys
+import time
+try:
+    import numpy
+    ndarray = numpy.ndarray
+except ImportError:
+    # Lists of numbers are then only Python lists
+    numpy = ndarray = None
 
 grammar = '''
 start: program
@@ -26,12 +42,14 @@ start: program
 ?return: "return" opexpr ";" -> returnfun
 
 ?assign: ID "=" opexpr -> assignvar
+    | ID ("[" opexpr "]")+ "=" opexpr -> setentry
 
 
 ?expr: "print" "(" opexpr ")" -> print
     | "if" "(" opexpr ")" "{" program "}" ("elif" "(" opexpr ")" "{" program "}")* ("else" "{" program "}")? -> ifexpr
     | "while" "(" opexpr ")" "{" program "}" -> whileexpr
     | "for" "(" decl ";" opexpr ";" assign ")" "{" program "}" -> forexpr
+    | "for" "(" type ":" ID "in" iterable ")" "{" program "}" -> foreach
     | opexpr
 
 ?opexpr: opexpr EQOP opexpr -> eqexpr
@@ -45,16 +63,35 @@ start: program
     | "!" opexpr -> notexpr
     | "nroot" "(" opexpr ";" opexpr ")" -> rootexpr
     | "size" "(" opexpr ")" -> size
+    | REDUCTION "(" opexpr ")" -> reduction
     | "toString" "(" opexpr ")" -> tostring
+    | "get" "(" opexpr ";" opexpr ")" -> mapget
+    | "put" "(" opexpr ";" opexpr ";" opexpr ")" -> mapput
+    | "has" "(" opexpr ";" opexpr ")" -> maphas
+    | "keys" "(" opexpr ")" -> mapkeys
+    | "contains" "(" opexpr ";" opexpr ")" -> contains
+    | SETOP "(" opexpr ";" opexpr ")" -> setop
+    | "matrix" "(" opexpr ")" -> matrix
+    | "matmul" "(" opexpr ";" opexpr ")" -> matmul
+    | "transpose" "(" opexpr ")" -> transpose
+    | "dot" "(" opexpr ";" opexpr ")" -> dot
+    | "row" "(" opexpr ";" opexpr ")" -> matrow
+    | "col" "(" opexpr ";" opexpr ")" -> matcol
+    | "rows" "(" opexpr ")" -> matrows
+    | "cols" "(" opexpr ")" -> matcols
     | ID "(" funargs ")" -> runfun
     | opexpr2
 
 ?opexpr2: opexpr "[" opexpr "]" -> getentryexpr
+    | opexpr "[" [opexpr] ":" [opexpr] "]" -> sliceexpr
     | opexpr "^" opexpr -> expexpr
     | atom
 
 funargs: ((opexpr ";")+ opexpr | opexpr?) -> funargs
 
+?iterable: "range" "(" opexpr ";" opexpr [";" opexpr] ")" -> range
+    | opexpr
+
 ?atom: BOOLEAN -> bool
     | INT -> int
     | FLOAT -> float
@@ -64,21 +101,30 @@ funargs: ((opexpr ";")+ opexpr | opexpr?) -> funargs
     | "(" opexpr ")"
     | "[" ((atom ";")+ atom | atom?) "]" -> list
     | "(" ((atom ";")* atom) ")" -> tuple
+    | "{" ((atom ":" atom ";")* atom ":" atom | ":") "}" -> map
+    | "{" ((atom ";")* atom)? "}" -> set
 
 
 
 ?type: TYPE -> type
     | type "[]" -> listtype
     | "(" ((type ";")* type) ")" -> tupletype
+    | "Map" "(" type ";" type ")" -> maptype
+    | "Set" "(" type ")" -> settype
 
 TYPE: "Int"
     | "Bool"
     | "Float"
     | "String"
+    | "Matrix"
 
 ID: /[_a-zA-Z][_a-zA-Z0-9]*/
 STRING: /\\\"[^\\\"]*\\\"/
 
+REDUCTION: "sum" | "min" | "max" | "mean" | "variance" | "stddev"
+
+SETOP: "union" | "intersection" | "difference"
+
 BOOLEAN: "True" | "False"
 
 ADDOP: "+" | "-"
@@ -106,6 +152,8 @@ class Env:
         self.o_varEnv = {}
         self.n_funEnv = {}
         self.o_funEnv = {}
+        self.parent = o_env
+        self.above = {}
         if o_env != None:
            self.o_varEnv = o_env.o_varEnv.copy()
            self.o_varEnv.update(o_env.n_varEnv)
@@ -113,11 +161,101 @@ class Env:
            self.o_funEnv.update(o_env.n_funEnv)
 
     
-    def update(self, i_env): 
+    def update(self, i_env, skip=None): 
+        if skip != None:
+            for (name, content) in i_env.o_varEnv.items():
+                if name in skip: continue
+                if (name in self.n_varEnv): self.n_varEnv[name] = content
+                else: self.o_varEnv[name] = content
+            return
         for (name, content) in i_env.o_varEnv.items():
             if (name in self.n_varEnv): self.n_varEnv[name] = content
             else: self.o_varEnv[name] = content
 
+    def holders(self, name, value):
+        # The scopes whose copies of a variable hold value, up to the scope
+        # that declares it. The others get it back when their scopes end.
+        # The scopes above one do not change before it ends, so it keeps
+        # their count for the value, which a recursive call then reuses
+        # instead of walking its callers again
+        chain = []
+        n = 0
+        env = self
+        while env != None:
+            if name in env.n_varEnv:
+                n = int(env.n_varEnv[name] is value)
+                break
+            elif env.o_varEnv.get(name) is not value: break
+            chain.append(env)
+            above = env.above.get(name)
+            if above != None and above[0] == id(value):
+                n = above[1]
+                break
+            env = env.parent
+        for env in reversed(chain):
+            env.above[name] = (id(value), n)
+            n += 1
+        return n
+
+def tailEnv(env, skip):
+    # The next call sees the variables of the call it replaces. Those that
+    # belong to the replaced call must not reach the caller when it is done
+    names = set(env.n_varEnv)
+    if skip != None: names |= skip
+    return (env, names)
+
+def stackAbove(n):
+    try:
+        sys._getframe(n)
+        return True
+    except ValueError:
+        return False
+
+def hasCalls(tree):
+    # Whether evaluating the tree can call a user function. Declaring a
+    # function does not call it
+    try: return tree.calls
+    except AttributeError: pass
+    calls = False
+    if tree.data == "runfun": calls = True
+    elif tree.data not in ("vfundecl", "tfundecl", "stfundecl"):
+        for child in tree.children:
+            if isinstance(child, Tree) and hasCalls(child):
+                calls = True
+                break
+    tree.calls = calls
+    return calls
+
+def declares(tree):
+    # Whether a block adds names to its scope. Blocks inside it have scopes
+    # of their own
+    try: return tree.declares
+    except AttributeError: pass
+    found = False
+    for statement in getStatements(tree):
+        if statement.data in ("vardecl", "hoistvar", "vfundecl", "tfundecl", "stfundecl"):
+            found = True
+            break
+    tree.declares = found
+    return found
+
+def blockTrees(tree):
+    if tree.data == "ifexpr":
+        exprs = tree.children
+        return exprs[1::2] + ([exprs[-1]] if len(exprs) % 2 == 1 else [])
+    elif tree.data == "whileexpr": return [tree.children[1]]
+    elif tree.data == "forexpr" or tree.data == "foreach": return [tree.children[3]]
+    elif tree.data == "branch": return [tree.children[0]]
+    return []
+
+def funCalls(fun):
+    (type, argslist, body, r) = fun
+    return (body is not None and hasCalls(body)) or (r is not None and hasCalls(r))
+
+def funKeyOf(fun):
+    (type, argslist, body, r) = fun
+    return body if r is None else r
+
 def isCompList(l, v):
     if isList(l) and isList(v):
         while isList(l) and isList(v):
@@ -140,12 +278,21 @@ def isCompTuple(l, r):
             return True
     return False
             
+def isCompMap(l, r):
+    if isMap(l) and isMap(r):
+        (kl, vl) = mapTypes(l)
+        (kr, vr) = mapTypes(r)
+        return checkType(kl, kr) and checkType(vl, vr)
+    return False
+
 def checkType(l,r):
     if l==r: return True
     if r=="Void": return True
     if l=="Float" and r=="Int": return True
     if isCompList(l,r): return True
     elif isCompTuple(l,r): return True
+    elif isCompMap(l,r): return True
+    elif isSet(l) and isSet(r): return checkType(l[4:-1], r[4:-1])
     else: return False
 
 def isList(l):
@@ -156,10 +303,491 @@ def isTuple(t):
     if (len(t) > 1 and t[0] == "(" and t[-1] == ")"): return True
     else: return False
 
+def isMap(t):
+    return len(t) > 5 and t[:4] == "Map(" and t[-1] == ")"
+
+def mapTypes(t):
+    # The key and value types of a map type
+    depth = 0
+    for i in range(4, len(t) - 1):
+        if t[i] == "(": depth += 1
+        elif t[i] == ")": depth -= 1
+        elif t[i] == ";" and depth == 0: return (t[4:i], t[i + 1:-1])
+
+def isHashable(t):
+    # Keys and set elements are looked up by their hash, which lists, maps,
+    # sets and matrices do not have
+    return "[]" not in t and "Map(" not in t and "Set(" not in t and "Matrix" not in t
+
+def mapType(k, v):
+    if not isHashable(k): raise TypeCheckError("Map keys can not be %s" % k)
+    return "Map(%s;%s)" % (k, v)
+
+def isSet(t):
+    return len(t) > 5 and t[:4] == "Set(" and t[-1] == ")"
+
+def setType(t):
+    if not isHashable(t): raise TypeCheckError("Set elements can not be %s" % t)
+    return "Set(%s)" % t
+
 def isFloat(t):
     if t == "Float" or t == "Int": return True
     else: return False
 
+def isNumList(t):
+    return t == "Int[]" or t == "Float[]"
+
+def vectorType(op, l, r):
+    # Arithmetic between a list of numbers and a number is done for each
+    # number of the list
+    if isNumList(l) and isFloat(r): (t, s) = (l[:-2], r)
+    elif isFloat(l) and isNumList(r): (t, s) = (r[:-2], l)
+    else: return None
+    if op == "/" or op == "^": return "Float[]"
+    return editType(t, s) + "[]"
+
+# Strings this long are added to as ropes
+ropeSize = 1024
+
+class Rope:
+    # A long string made by adding strings, kept as its parts until it is
+    # read. Adding to the newest rope over a list of parts appends to the
+    # list it shares with the ropes before it, so building a string by
+    # adding to it does not copy it
+    __slots__ = ("parts", "count", "length", "flat")
+
+    def __init__(self, parts, length):
+        self.parts = parts
+        self.count = len(parts)
+        self.length = length
+        self.flat = None
+
+    def __str__(self):
+        if self.flat is None: self.flat = "".join(self.parts[:self.count])
+        return self.flat
+
+    def __repr__(self):
+        return repr(str(self))
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        # The end of the string is in its last part
+        if self.flat is None and i < 0:
+            last = self.parts[self.count - 1]
+            if -i <= len(last): return last[i]
+        return str(self)[i]
+
+    def __eq__(self, other):
+        if type(other) is not Rope and type(other) is not str: return NotImplemented
+        return str(self) == str(other)
+
+    def __hash__(self):
+        return hash(str(self))
+
+    def __add__(self, other):
+        if type(other) is Rope: other = str(other)
+        elif type(other) is not str: return NotImplemented
+        parts = self.parts
+        if len(parts) != self.count: parts = parts[:self.count]
+        parts.append(other)
+        return Rope(parts, self.length + len(other))
+
+    def __radd__(self, other):
+        if type(other) is not str: return NotImplemented
+        return Rope([other] + self.parts[:self.count], len(other) + self.length)
+
+class ListView:
+    # l[a:b] of a list, which reads the list instead of copying it. A list
+    # is only changed in place while nothing else refers to it, so the
+    # view keeps its values
+    __slots__ = ("base", "start", "stop")
+
+    def __init__(self, base, start, stop):
+        self.base = base
+        self.start = start
+        self.stop = stop
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __getitem__(self, i):
+        # Indices are checked against the length first
+        if i < 0: i += self.stop - self.start
+        return self.base[self.start + i]
+
+    def __iter__(self):
+        return islice(self.base, self.start, self.stop)
+
+    def __repr__(self):
+        return repr(self.tolist())
+
+    def tolist(self):
+        return self.base[self.start:self.stop]
+
+def sliceValue(v, a, b):
+    # v[a:b] with the bounds of Python slices. Lists give views, and arrays
+    # give NumPy views. Strings are copied, since Python has no views of them
+    (start, stop, step) = slice(a, b).indices(len(v))
+    stop = max(start, stop)
+    if type(v) is list: return ListView(v, start, stop)
+    elif type(v) is ListView: return ListView(v.base, v.start + start, v.start + stop)
+    elif type(v) is Rope: return str(v)[start:stop]
+    return v[start:stop]
+
+def joinStrings(v1, v2):
+    if type(v1) is str and type(v2) is str and len(v1) >= ropeSize: return Rope([v1, v2], len(v1) + len(v2))
+    return v1 + v2
+
+def isEqual(v1, v2):
+    t1 = type(v1)
+    t2 = type(v2)
+    if t1 is bool or t2 is bool:
+        # Booleans used to be the strings "True"/"False", so they only equal
+        # other booleans or those exact strings, never 0 or 1
+        if t1 is t2: return v1 == v2
+        elif t1 is str or t2 is str or t1 is Rope or t2 is Rope: return str(v1) == str(v2)
+        else: return False
+    elif t1 is ndarray or t1 is ListView: return isEqual(v1.tolist(), v2)
+    elif t2 is ndarray or t2 is ListView: return isEqual(v1, v2.tolist())
+    elif (t1 is list or t1 is tuple) and t1 is t2:
+        if len(v1) != len(v2): return False
+        for i in range(len(v1)):
+            if not isEqual(v1[i], v2[i]): return False
+        return True
+    elif t1 is set and t2 is set: return v1 == v2
+    elif t1 is dict and t2 is dict:
+        if len(v1) != len(v2): return False
+        for (k, v) in v1.items():
+            if k not in v2 or not isEqual(v, v2[k]): return False
+        return True
+    else: return v1 == v2
+
+def powerValue(v, n):
+    # v ^ n for a constant n from 2 to 4. Floats are only squared by
+    # multiplying, since more products round differently than pow
+    if type(v) is int:
+        value = v
+        for i in range(n - 1):
+            value = value * v
+        return value
+    elif type(v) is float and n == 2:
+        value = v * v
+        # pow fails on overflow instead of giving inf
+        if value != math.inf or v == math.inf or v == -math.inf: return value
+    elif type(v) in listTypes: return vectorValue("^", v, n)
+    return v**n
+
+def sqrtValue(v):
+    # nroot(v; 2). Zero keeps the sign pow gives it
+    if (type(v) is float or type(v) is int) and v > 0: return math.sqrt(v)
+    return v**(1/2)
+
+vectorOps = {"+": operator.add, "-": operator.sub, "*": operator.mul, "/": operator.truediv, "^": operator.pow}
+
+def numbers(v):
+    # A list as an array, when its numbers all have the same type
+    if type(v) is ndarray: return v
+    types = set(map(type, v))
+    if types == {float}: return numpy.fromiter(v, numpy.float64, len(v))
+    elif types != {int}: return None
+    try: return numpy.fromiter(v, numpy.int64, len(v))
+    except OverflowError: return None
+
+def arrayValue(op, v1, v2):
+    # op between an array and a number, or None when NumPy would not give
+    # exactly the numbers Python gives: ints that may leave 64 bits, int
+    # division that may round twice, float powers, which NumPy rounds
+    # differently, and results with errors, inf or nan
+    if numpy is None: return None
+    if type(v1) is list or type(v1) is ndarray: (l, s) = (v1, v2)
+    else: (l, s) = (v2, v1)
+    t = type(s)
+    if (t is not int and t is not float) or (type(l) is not list and type(l) is not ndarray): return None
+    a = numbers(l)
+    if a is None: return None
+    if a.dtype.kind == "i":
+        m = max(-int(a.min()), int(a.max()))
+        if t is float:
+            if op == "^" or m > 2**53: return None
+        elif abs(s) >= 2**63: return None
+        elif op == "+" or op == "-":
+            if m + abs(s) >= 2**63: return None
+        elif op == "*":
+            if m * abs(s) >= 2**63: return None
+        elif op == "/":
+            if m > 2**53 or abs(s) > 2**53: return None
+        elif l is v1:
+            if s < 0 or (m > 1 and (s >= 64 or m**s >= 2**63)): return None
+        elif int(a.min()) < 0 or (abs(s) > 1 and (m >= 64 or abs(s)**m >= 2**63)): return None
+    elif op == "^" or (t is int and abs(s) > 2**53): return None
+    # Python fails on any division by zero, NumPy only on some
+    if op == "/" and (s == 0 if l is v1 else (a == 0).any()): return None
+    if l is v1: (v1, v2) = (a, s)
+    else: (v1, v2) = (s, a)
+    try:
+        with numpy.errstate(divide = "raise", over = "raise", invalid = "raise", under = "ignore"):
+            return vectorOps[op](v1, v2)
+    except FloatingPointError: return None
+
+listTypes = (list, ListView, ndarray) if numpy is not None else (list, ListView)
+
+def arithValue(op, v1, v2):
+    # The operators of nodes that were not typed for lists
+    if type(v1) in listTypes or type(v2) in listTypes: return vectorValue(op, v1, v2)
+    elif op == "+": return joinStrings(v1, v2)
+    return vectorOps[op](v1, v2)
+
+def vectorValue(op, v1, v2):
+    # op between each number of a list and a number
+    if type(v1) is ListView: v1 = v1.tolist()
+    if type(v2) is ListView: v2 = v2.tolist()
+    value = arrayValue(op, v1, v2)
+    if value is not None: return value
+    if op == "+" and (type(v1) is list or type(v1) is ndarray) and (type(v2) is list or type(v2) is ndarray):
+        return concatValues(v1, v2)
+    f = vectorOps[op]
+    if type(v1) is ndarray: v1 = v1.tolist()
+    if type(v2) is ndarray: v2 = v2.tolist()
+    if type(v1) is list and type(v2) is not list: return [f(x, v2) for x in v1]
+    elif type(v2) is list and type(v1) is not list: return [f(v1, x) for x in v2]
+    return f(v1, v2)
+
+def concatValues(v1, v2):
+    # Arrays stay arrays when joined to numbers of the same type
+    if type(v1) is ListView: v1 = v1.tolist()
+    if type(v2) is ListView: v2 = v2.tolist()
+    if type(v1) is ndarray or type(v2) is ndarray:
+        a1 = numbers(v1) if len(v1) > 0 else None
+        a2 = numbers(v2) if len(v2) > 0 else None
+        if a1 is not None and a2 is not None and a1.dtype == a2.dtype: return numpy.concatenate((a1, a2))
+        if type(v1) is ndarray: v1 = v1.tolist()
+        if type(v2) is ndarray: v2 = v2.tolist()
+    return v1 + v2
+
+def sumValue(v):
+    # Added from the left, like a loop over the list would
+    if type(v) is not ndarray: return reduce(operator.add, v, 0)
+    elif len(v) == 0: return 0
+    elif v.dtype.kind == "f":
+        with numpy.errstate(over = "ignore", invalid = "ignore"):
+            return numpy.cumsum(v)[-1].item() + 0
+    elif max(-int(v.min()), int(v.max())) * len(v) < 2**63: return int(v.sum())
+    return sum(v.tolist())
+
+def extremeValue(name, v):
+    if len(v) == 0: raise Exception("%s of an empty list" % name)
+    if type(v) is ndarray:
+        value = (v.min() if name == "min" else v.max()).item()
+        # NaN and the sign of zero depend on the order Python compares in
+        if v.dtype.kind == "i" or (value == value and value != 0): return value
+        v = v.tolist()
+    return min(v) if name == "min" else max(v)
+
+def meanValue(v):
+    if len(v) == 0: raise Exception("mean of an empty list")
+    return sumValue(v) / len(v)
+
+def varianceValue(v):
+    # Of a sample, from the squares of the differences to the mean
+    if len(v) < 2: raise Exception("variance of fewer than 2 numbers: %s" % showValue(v))
+    m = meanValue(v)
+    if type(v) is ndarray:
+        try:
+            with numpy.errstate(over = "raise", invalid = "raise", under = "ignore"):
+                d = v - m
+                return sumValue(d * d) / (len(v) - 1)
+        except FloatingPointError: v = v.tolist()
+    return reduce(operator.add, [powerValue(x - m, 2) for x in v], 0) / (len(v) - 1)
+
+reductions = {
+    "sum": sumValue,
+    "min": lambda v: extremeValue("min", v),
+    "max": lambda v: extremeValue("max", v),
+    "mean": meanValue,
+    "variance": varianceValue,
+    "stddev": lambda v: sqrtValue(varianceValue(v)),
+}
+
+def refCount(value):
+    return sys.getrefcount(value)
+
+def ownRefs():
+    # What refCount gives for a list that a local variable of its caller
+    # holds, besides the scopes. It differs between Python versions, and
+    # Pythons without reference counts never append in place
+    if not hasattr(sys, "getrefcount"): return None
+    env = {"x": []}
+    value = env["x"]
+    return refCount(value) - 1
+
+localRefs = ownRefs()
+
+def appendValue(value, other, owned):
+    # value + other, which extends value when nothing else can see it
+    if owned and type(value) is list:
+        if type(other) is list: value.extend(other)
+        elif type(other) is ndarray or type(other) is ListView: value.extend(other.tolist())
+        else: return concatValues(value, other)
+        return value
+    return concatValues(value, other)
+
+def entryRefs(list, i):
+    return refCount(list[i])
+
+def ownEntryRefs():
+    # What entryRefs gives for a list that only the list it is in holds
+    if not hasattr(sys, "getrefcount"): return None
+    return entryRefs([[]], 0)
+
+listRefs = ownEntryRefs()
+
+def isWritable(value):
+    # Lists, and matrices that are not views of other matrices
+    return type(value) is list or (type(value) is ndarray and value.ndim == 2 and value.base is None)
+
+def writableCopy(value):
+    # A copy that can be written. Views and arrays of numbers become lists
+    if type(value) is ndarray: return value.copy() if value.ndim == 2 else value.tolist()
+    elif type(value) is ListView: return value.tolist()
+    return list(value)
+
+def setEntryValue(value, indices, v, owned, floats = False):
+    # value with value[i][j]... set to v. The lists on the way are changed
+    # in place when nothing else can see them and copied first otherwise.
+    # Numbers of matrices are floats, also without NumPy
+    if floats: v = float(v) if len(indices) == 2 else [float(x) for x in iterValues(v)]
+    if not owned or not isWritable(value): value = writableCopy(value)
+    list = value
+    for n in range(len(indices)):
+        i = indices[n]
+        if not ((i < len(list) and i >= 0) or (i >= -len(list) and i < 0)):
+            raise Exception("%s is out of bounds: %s" %(i, showValue(list)))
+        if type(list) is ndarray:
+            # A row of a matrix, or one number of it
+            if n == len(indices) - 1:
+                row = [float(x) for x in iterValues(v)]
+                if len(row) != list.shape[1]: raise Exception("A row of %d numbers can not replace a row of %d" % (len(row), list.shape[1]))
+                list[i] = row
+            else:
+                j = indices[n + 1]
+                if not ((j < list.shape[1] and j >= 0) or (j >= -list.shape[1] and j < 0)):
+                    raise Exception("%s is out of bounds: %s" %(j, showValue(list[i])))
+                list[i, j] = v
+            return value
+        elif n == len(indices) - 1: list[i] = v
+        else:
+            if listRefs is None or entryRefs(list, i) != listRefs or not isWritable(list[i]): list[i] = writableCopy(list[i])
+            list = list[i]
+    return value
+
+def keyValue(k):
+    # Ropes are keys as the strings they make
+    return str(k) if type(k) is Rope else k
+
+def getValue(m, k):
+    if k in m: return m[k]
+    raise Exception("Key not found: %s" % showValue(k))
+
+def putValue(m, k, v, owned):
+    # m with k mapped to v, which changes m when nothing else can see it
+    if not owned: m = m.copy()
+    m[keyValue(k)] = v
+    return m
+
+setOps = {"union": operator.or_, "intersection": operator.and_, "difference": operator.sub}
+setUpdates = {"union": operator.ior, "intersection": operator.iand, "difference": operator.isub}
+
+def setValue(name, s1, s2, owned):
+    # union, intersection or difference of s1 and s2, which changes s1 when
+    # nothing else can see it
+    if owned: return setUpdates[name](s1, s2)
+    return setOps[name](s1, s2)
+
+class SetOut(list):
+    # A set as it is shown, with its elements sorted, since the order sets
+    # keep them in changes between runs
+    def __repr__(self):
+        return "{" + list.__repr__(self)[1:-1] + "}"
+
+def sortedValues(v):
+    try: return sorted(v)
+    except TypeError: return list(v)
+
+def matrixValue(l):
+    # A list of rows of numbers as a matrix of floats, which is an array
+    # when NumPy is installed and a list of lists of floats otherwise
+    if len(l) == 0: raise Exception("A matrix needs at least one row")
+    n = len(l[0])
+    for row in l:
+        if len(row) != n: raise Exception("Rows of a matrix must have the same length: %s" % showValue(l))
+    try: rows = [[float(x) for x in row] for row in l]
+    except OverflowError: raise Exception("Number too large for a matrix: %s" % showValue(l))
+    if numpy is None: return rows
+    return numpy.array(rows, numpy.float64)
+
+def shapeOf(m):
+    if type(m) is ndarray: return m.shape
+    return (len(m), len(m[0]))
+
+def matmulValue(a, b):
+    ((n, k), (k2, m)) = (shapeOf(a), shapeOf(b))
+    if k != k2: raise Exception("Can not multiply a %dx%d matrix by a %dx%d matrix" % (n, k, k2, m))
+    if type(a) is ndarray: return a @ b
+    return [[reduce(operator.add, [a[i][x] * b[x][j] for x in range(k)], 0.0) for j in range(m)] for i in range(n)]
+
+def transposeValue(a):
+    if type(a) is ndarray: return a.T
+    return [list(row) for row in zip(*a)]
+
+def dotValue(u, v):
+    if len(u) != len(v): raise Exception("Can not take the dot product of %d and %d numbers" % (len(u), len(v)))
+    if numpy is not None:
+        # Only floats, since ints may leave 64 bits. The products are added
+        # from the left like a loop would
+        (a, b) = (numbers(u), numbers(v))
+        if a is not None and b is not None and a.dtype.kind == "f" and b.dtype.kind == "f":
+            with numpy.errstate(over = "ignore", invalid = "ignore", under = "ignore"):
+                return sumValue(a * b)
+    return reduce(operator.add, map(operator.mul, iterValues(u), iterValues(v)), 0)
+
+def rowValue(a, i):
+    n = shapeOf(a)[0]
+    if i >= n or i < -n: raise Exception("Row %s is out of bounds: %s" % (i, showValue(a)))
+    return a[i]
+
+def colValue(a, j):
+    n = shapeOf(a)[1]
+    if j >= n or j < -n: raise Exception("Column %s is out of bounds: %s" % (j, showValue(a)))
+    if type(a) is ndarray: return a[:, j]
+    return [row[j] for row in a]
+
+def rangeValue(a, b, step):
+    if step == 0: raise Exception("range step can not be 0")
+    return range(a, b, 1 if step is None else step)
+
+def iterValues(v):
+    # The values a for each loop gives its variable
+    t = type(v)
+    if t is Rope: return str(v)
+    elif t is ndarray: return v.tolist()
+    return v
+
+def outValue(v):
+    t = type(v)
+    if t is bool: return str(v)
+    elif t is list: return [outValue(x) for x in v]
+    elif t is dict: return dict([(outValue(k), outValue(x)) for (k, x) in v.items()])
+    elif t is set: return SetOut([outValue(x) for x in sortedValues(v)])
+    elif t is tuple: return tuple(outValue(x) for x in v)
+    elif t is ndarray: return v.tolist()
+    elif t is ListView: return outValue(v.tolist())
+    else: return v
+
+def showValue(v):
+    return str(outValue(v))
+
 def editCompList(l, r):
     n = ""
     while isList(l) and isList(r):
@@ -197,17 +825,58 @@ def editType(l,r):
     elif len(l) > 1 and len(r) > 1 and l[0] == "(" and r[0] == "(" and l[-1] == ")" and r[-1] == ")":
         n = editCompTuple(l, r)
         return n
+    elif isMap(l) and isMap(r):
+        (kl, vl) = mapTypes(l)
+        (kr, vr) = mapTypes(r)
+        return mapType(editType(kl, kr), editType(vl, vr))
+    elif isSet(l) and isSet(r):
+        return setType(editType(l[4:-1], r[4:-1]))
     else: 
         raise Exception()
     
 
 
-class TypeChecker(Interpreter): 
-    def __init__(self, o_env = None):
+# Nodes of builtins that are called like functions, with their names
+builtinNames = {"mapget": "get", "mapput": "put", "maphas": "has", "mapkeys": "keys", "contains": "contains",
+    "matrix": "matrix", "matmul": "matmul", "transpose": "transpose", "dot": "dot",
+    "matrow": "row", "matcol": "col", "matrows": "rows", "matcols": "cols"}
+
+class Handlers(dict):
+    # The handler of each node type of a class, looked up the first time a
+    # node of that type is visited. Types without one get __default__
+    def __init__(self, cls):
+        self.cls = cls
+
+    def __missing__(self, data):
+        f = getattr(self.cls, data, None)
+        if f is None or data[0] == "_": f = self.cls.__default__
+        self[data] = f
+        return f
+
+class Dispatcher(Interpreter):
+    # Calls handlers straight from the table of the class instead of looking
+    # them up by name on every node like Interpreter
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.handlers = Handlers(cls)
+
+    def visit(self, tree):
+        return self.handlers[tree.data](self, tree)
+
+    _visit_tree = visit
+
+class TypeCheckError(Exception):
+    # The errors the type checker reports about a program
+    pass
+
+class TypeChecker(Dispatcher): 
+    def __init__(self, o_env = None, checking = None):
         self.env = Env(o_env)
+        # The functions whose bodies are being checked
+        self.checking = checking if checking != None else set()
     
     def typeError(self, t1, t2):
-        raise Exception("Type error: Expected %s, got %s" % (t1, t2))
+        raise TypeCheckError("Type error: Expected %s, got %s" % (t1, t2))
     
     def addVar(self, name, value):
         self.env.n_varEnv[name] = value
@@ -215,14 +884,15 @@ class TypeChecker(Interpreter):
     def getVar(self, name):
         if (name in self.env.n_varEnv): return self.env.n_varEnv[name]
         elif (name in self.env.o_varEnv): return self.env.o_varEnv[name]
-        else: raise Exception("Variable not found: %s" % name)
+        else: raise TypeCheckError("Variable not found: %s" % name)
     
     def addFun(self, name, args, body=None, r=None, type="Void"):
         self.env.n_funEnv[name] = (type, args, body, r)
 
     def getFun(self, name):
         if (name in self.env.n_funEnv): return self.env.n_funEnv[name]
-        else: return self.env.o_funEnv[name]
+        elif (name in self.env.o_funEnv): return self.env.o_funEnv[name]
+        else: raise TypeCheckError("Function not found: %s" % name)
 
     def int(self, tree):
         return "Int"
@@ -242,7 +912,8 @@ class TypeChecker(Interpreter):
         elif type == "Int": return "Int"
         elif type == "Float": return "Float"
         elif type == "String": return "String"
-        else: raise Exception("Type not valid: %s" % type)
+        elif type == "Matrix": return "Matrix"
+        else: raise TypeCheckError("Type not valid: %s" % type)
     
     def list(self, tree):
         contents = tree.children
@@ -253,7 +924,7 @@ class TypeChecker(Interpreter):
                 value = self.visit(content)
                 try:
                     type = editType(type, value)
-                except: raise Exception("List can only have one type, but got: %s, %s" %(type, value))
+                except: raise TypeCheckError("List can only have one type, but got: %s, %s" %(type, value))
                 #if value != type: 
                 #    if isCompList(value, type): type == value 
                 #    elif not isCompList(type, value): raise Exception("List can only have one type, but got: %s, %s" %(type, value))
@@ -281,15 +952,164 @@ class TypeChecker(Interpreter):
             values = values + value + ";"
         if (values[-1] == ";"): values = values[:-1]
         return values + ")"
+
+    def map(self, tree):
+        contents = tree.children
+        (k, v) = ("Void", "Void")
+        for i in range(0, len(contents), 2):
+            kt = self.visit(contents[i])
+            vt = self.visit(contents[i + 1])
+            try:
+                k = editType(k, kt)
+                v = editType(v, vt)
+            except: raise TypeCheckError("Map can only have one key and one value type, but got: %s: %s, %s: %s" %(k, v, kt, vt))
+        return mapType(k, v)
+
+    def maptype(self, tree):
+        (k, v) = tree.children
+        return mapType(self.visit(k), self.visit(v))
+
+    def mapKey(self, tree):
+        # The type of a map and of a key looked up in it
+        (e1, e2) = tree.children[:2]
+        t = self.visit(e1)
+        if not isMap(t): self.typeError("Map", t)
+        (k, v) = mapTypes(t)
+        kt = self.visit(e2)
+        if k != "Void" and not checkType(k, kt): self.typeError(k, kt)
+        return (t, v)
+
+    def mapget(self, tree):
+        if self.userFun(tree): return self.visit(tree)
+        return self.mapKey(tree)[1]
+
+    def maphas(self, tree):
+        if self.userFun(tree): return self.visit(tree)
+        self.mapKey(tree)
+        return "Bool"
+
+    def mapput(self, tree):
+        if self.userFun(tree): return self.visit(tree)
+        (t, v) = self.mapKey(tree)
+        vt = self.visit(tree.children[2])
+        if v != "Void" and not checkType(v, vt): self.typeError(v, vt)
+        elif mapTypes(t)[0] != "Void": return mapType(mapTypes(t)[0], editType(v, vt))
+        return mapType(self.visit(tree.children[1]), vt)
+
+    def mapkeys(self, tree):
+        if self.userFun(tree): return self.visit(tree)
+        t = self.visit(tree.children[0])
+        if not isMap(t): self.typeError("Map", t)
+        return mapTypes(t)[0] + "[]"
+
+    def set(self, tree):
+        t = "Void"
+        for content in tree.children:
+            value = self.visit(content)
+            try: t = editType(t, value)
+            except: raise TypeCheckError("Set can only have one type, but got: %s, %s" %(t, value))
+        return setType(t)
+
+    def settype(self, tree):
+        return setType(self.visit(tree.children[0]))
+
+    def contains(self, tree):
+        if self.userFun(tree): return self.visit(tree)
+        (e1, e2) = tree.children
+        t = self.visit(e1)
+        if not isSet(t): self.typeError("Set", t)
+        v = self.visit(e2)
+        if t[4:-1] != "Void" and not checkType(t[4:-1], v): self.typeError(t[4:-1], v)
+        return "Bool"
+
+    def setop(self, tree):
+        if self.userFun(tree): return self.visit(tree)
+        (name, e1, e2) = tree.children
+        t1 = self.visit(e1)
+        t2 = self.visit(e2)
+        if not isSet(t1): self.typeError("Set", t1)
+        elif not isSet(t2): self.typeError("Set", t2)
+        try: return editType(t1, t2)
+        except: raise TypeCheckError("'%s(%s; %s)' is not supported" %(name, t1, t2))
+
+    def matrices(self, tree):
+        for e in tree.children:
+            t = self.visit(e)
+            if t != "Matrix": self.typeError("Matrix", t)
+
+    def matrix(self, tree):
+        if self.userFun(tree): return self.visit(tree)
+        t = self.visit(tree.children[0])
+        if t not in ("Int[][]", "Float[][]", "Void[]"): self.typeError("Int[][] or Float[][]", t)
+        return "Matrix"
+
+    def matmul(self, tree):
+        if self.userFun(tree): return self.visit(tree)
+        self.matrices(tree)
+        return "Matrix"
+
+    def transpose(self, tree):
+        if self.userFun(tree): return self.visit(tree)
+        self.matrices(tree)
+        return "Matrix"
+
+    def dot(self, tree):
+        if self.userFun(tree): return self.visit(tree)
+        (e1, e2) = tree.children
+        v1 = self.visit(e1)
+        v2 = self.visit(e2)
+        if not isNumList(v1): self.typeError("Int[] or Float[]", v1)
+        elif not isNumList(v2): self.typeError("Int[] or Float[]", v2)
+        elif v1 == "Int[]" and v2 == "Int[]": return "Int"
+        return "Float"
+
+    def matrow(self, tree):
+        if self.userFun(tree): return self.visit(tree)
+        (e1, e2) = tree.children
+        self.matrices(Tree("matrices", [e1]))
+        i = self.visit(e2)
+        if not checkType("Int", i): self.typeError("Int", i)
+        return "Float[]"
+
+    matcol = matrow
+
+    def matrows(self, tree):
+        if self.userFun(tree): return self.visit(tree)
+        self.matrices(tree)
+        return "Int"
+
+    matcols = matrows
     
     def getentryexpr(self, tree):
         (e1, e2) = tree.children
         t = self.visit(e1)
+        if isMap(t):
+            # m[k] reads like get(m; k)
+            tree.data = "mapEntry"
+            (k, v) = mapTypes(t)
+            kt = self.visit(e2)
+            if k != "Void" and not checkType(k, kt): self.typeError(k, kt)
+            return v
+        if isSet(t): raise TypeCheckError("Sets have no entries to index, but got %s. Use contains(set; element)" % t)
+        tree.data = "getentryexpr"
         i = self.visit(e2)
         if not checkType("Int", i): self.typeError("Int", i)
         elif isList(t): return t[:-2]
         elif isTuple(t): return "Void" #
         elif t == "String": return "String"
+        elif t == "Matrix": return "Float[]"
+
+    mapEntry = getentryexpr
+
+    def sliceexpr(self, tree):
+        (e1, e2, e3) = tree.children
+        t = self.visit(e1)
+        for e in (e2, e3):
+            if e is None: continue
+            i = self.visit(e)
+            if not checkType("Int", i): self.typeError("Int", i)
+        if isList(t) or t == "String": return t
+        self.typeError("List or String", t)
 
     def negative(self, tree):
         value = tree.children[0]
@@ -312,6 +1132,21 @@ class TypeChecker(Interpreter):
         if not checkType(type, value): self.typeError(type, value)
         #self.env.env[name] = self.visit(value)
 
+    def setentry(self, tree):
+        name = tree.children[0]
+        type = self.getVar(name)
+        if type == "Matrix": tree.data = "setMatrix"
+        for e in tree.children[1:-1]:
+            i = self.visit(e)
+            if not checkType("Int", i): self.typeError("Int", i)
+            elif isList(type): type = type[:-2]
+            elif type == "Matrix": type = "Float[]"
+            else: raise TypeCheckError("Expected a list or Matrix to assign an entry of, but got %s" % type)
+        value = self.visit(tree.children[-1])
+        if not checkType(type, value): self.typeError(type, value)
+
+    setMatrix = setentry
+
     def var(self, tree):
         name = tree.children[0]
         return self.getVar(name)
@@ -325,27 +1160,62 @@ class TypeChecker(Interpreter):
         (name, args, body) = tree.children
         argslist = self.visit(args)
         self.addFun(name, argslist, body)
+        self.precheck(name)
     
     def tfundecl(self, tree):
         (type, name, args, body, r) = tree.children
         argslist = self.visit(args)
         self.addFun(name, argslist, body, r, type)
+        self.precheck(name)
     
     def stfundecl(self, tree):
         (type, name, args, r) = tree.children
         argslist = self.visit(args)
         self.addFun(name, argslist, None, r, type)
+        self.precheck(name)
+
+    def precheck(self, name):
+        # The body is checked for the types of the arguments where it is
+        # declared, since the nodes it retypes only reach the optimized tree
+        # that runs it when they are retyped before it is optimized. Calls
+        # check it for the variables they see, and report the errors
+        fun = self.getFun(name)
+        (type, argslist, body, r) = fun
+        i_tc = TypeChecker(self.env, self.checking)
+        for (argtype, argname) in argslist:
+            i_tc.addVar(argname, argtype)
+        self.checking.add(id(fun))
+        try:
+            if body != None: i_tc.visit(body)
+            if r != None: i_tc.visit(r)
+        except TypeCheckError: pass
+        except (TypeError, AttributeError, KeyError, IndexError, ValueError):
+            # The checker also fails on types it does not expect, like the
+            # None of "a" + 1. Those too are left to the calls, as before
+            pass
+        finally: self.checking.discard(id(fun))
     
     def runfun(self, tree):
         (name, argsv) = tree.children
-        (type, argslist, body, r) = self.getFun(name)
+        fun = self.getFun(name)
+        (type, argslist, body, r) = fun
         argsvalues = self.visit(argsv)
-        i_ev = TypeChecker(self.env)
+        if len(argsvalues) < len(argslist): raise TypeCheckError("Expected %d arguments for %s, got %d" % (len(argslist), name, len(argsvalues)))
+        i_ev = TypeChecker(self.env, self.checking)
         for i in range(len(argslist)):
             (argtype, argname) = argslist[i]
             argvalue = argsvalues[i]
             if not checkType(argtype, argvalue): self.typeError(argtype, argvalue)
             i_ev.addVar(argname, argvalue)
+        # A recursive call is checked by the call that is already running
+        if id(fun) in self.checking:
+            if type != "Void": return self.visit(type)
+            return
+        self.checking.add(id(fun))
+        try: return self.checkFun(i_ev, type, body, r)
+        finally: self.checking.discard(id(fun))
+
+    def checkFun(self, i_ev, type, body, r):
         if type != "Void":
             t = self.visit(type)
             if body != None:
@@ -388,17 +1258,27 @@ class TypeChecker(Interpreter):
         v3 = self.visit(e3)
         if v1 == "Int" and v3 == "Int": return "Int"
         elif isFloat(v1) and isFloat(v3): return "Float"
+        t = vectorType(str(e2), v1, v3)
+        if t is not None:
+            tree.data = "addVector"
+            return t
         if e2 == "+":
             if v1 == "String" and v3 == "String": return "String"
             elif isList(v1) and isList(v1): 
-                try: return editType(v1, v3)
-                except: raise Exception("'%s + %s' is not supported" %(v1, v3))
-        else: raise Exception("'%s + %s' is not supported with %s" %(v1, v3, e2))
+                try: t = editType(v1, v3)
+                except: raise TypeCheckError("'%s + %s' is not supported" %(v1, v3))
+                tree.data = "concatLists"
+                return t
+        else: raise TypeCheckError("'%s + %s' is not supported with %s" %(v1, v3, e2))
     
     def mulexpr(self, tree):
         (e1, e2, e3) = tree.children
         v1 = self.visit(e1)
         v3 = self.visit(e3)
+        t = vectorType(str(e2), v1, v3)
+        if t is not None:
+            tree.data = "mulVector"
+            return t
         if not isFloat(v1): self.typeError("Int or Float", v1)
         elif not isFloat(v3): self.typeError("Int or Float", v3)
         elif e2 == "/" or v1 == "Float" or v3 == "Float": return "Float"
@@ -408,9 +1288,18 @@ class TypeChecker(Interpreter):
         (e1, e2) = tree.children
         v1 = self.visit(e1)
         v2 = self.visit(e2)
+        t = vectorType("^", v1, v2)
+        if t is not None:
+            tree.data = "powVector"
+            return t
         if not isFloat(v1): self.typeError("Int or Float", v1)
         elif not isFloat(v2): self.typeError("Int or Float", v2)
         else: return "Float"
+
+    # Nodes typed as lists and numbers before, which are typed again
+    addVector = concatLists = addexpr
+    mulVector = mulexpr
+    powVector = expexpr
     
     def rootexpr(self, tree):
         (e1, e2) = tree.children
@@ -448,11 +1337,30 @@ class TypeChecker(Interpreter):
         elif not isFloat(v3): self.typeError("Int or Float", v3)
         return "Bool"
 
+    def userFun(self, tree):
+        # A function of the same name as a builtin is called instead of it
+        children = tree.children
+        if tree.data in builtinNames: name = builtinNames[tree.data]
+        else: (name, children) = (children[0], children[1:])
+        name = Token("ID", str(name))
+        if name not in self.env.n_funEnv and name not in self.env.o_funEnv: return False
+        tree.data = "runfun"
+        tree.children = [name, Tree("funargs", children)]
+        return True
+
+    def reduction(self, tree):
+        if self.userFun(tree): return self.visit(tree)
+        (name, e) = tree.children
+        v = self.visit(e)
+        if not isNumList(v): self.typeError("Int[] or Float[]", v)
+        elif name in ("sum", "min", "max"): return v[:-2]
+        else: return "Float"
+
     def size(self, tree):
         e = tree.children[0]
         v = self.visit(e)
-        if isList(v) or isTuple(v) or v == "String": return "Int"
-        raise Exception("Expected a list, tuple or String, but got %s" % v)
+        if isList(v) or isTuple(v) or isMap(v) or isSet(v) or v == "String": return "Int"
+        raise TypeCheckError("Expected a list, tuple, map, set or String, but got %s" % v)
     
     def ifexpr(self, tree):
         exprs = tree.children
@@ -464,37 +1372,53 @@ class TypeChecker(Interpreter):
             if v1 != "Bool": self.typeError("Bool", v1)
             else:
                 e2 = exprs[i+1]
-                i_ev = TypeChecker(self.env)
-                i_ev.visit(e2)
-                self.env.update(i_ev.env)
+                self.scope(e2)
                 i=i+2
         if (i == lenght):
             e = exprs[i]
-            i_ev = TypeChecker(self.env)
-            i_ev.visit(e)
-            self.env.update(i_ev.env)
+            self.scope(e)
+
+    def scope(self, tree):
+        if not declares(tree): return self.visit(tree)
+        i_ev = TypeChecker(self.env, self.checking)
+        i_ev.visit(tree)
+        self.env.update(i_ev.env)
     
     def whileexpr(self, tree):
         (cond, e) = tree.children
         condType = self.visit(cond)
-        if condType == "Bool":
-            i_ev = TypeChecker(self.env)
-            i_ev.visit(e)
-            self.env.update(i_ev.env)
+        if condType == "Bool": self.scope(e)
         else: self.typeError("Bool", condType)
     
     def forexpr(self, tree):
         (e1, e2, e3, e4) = tree.children
-        i_ev = TypeChecker(self.env)
+        i_ev = TypeChecker(self.env, self.checking)
         i_ev.visit(e1)
         type = i_ev.visit(e2)
         if type == "Bool":
-            ii_ev = TypeChecker(i_ev.env)
-            ii_ev.visit(e4)
-            i_ev.env.update(ii_ev.env)
+            i_ev.scope(e4)
             i_ev.visit(e3)
         self.env.update(i_ev.env)
 
+    def foreach(self, tree):
+        (type, name, e, body) = tree.children
+        t = self.visit(type)
+        v = self.visit(e)
+        if isList(v): v = v[:-2]
+        elif v != "String": raise TypeCheckError("Expected a list, String or range, but got %s" % v)
+        if not checkType(t, v): self.typeError(t, v)
+        i_ev = TypeChecker(self.env, self.checking)
+        i_ev.addVar(name, t)
+        i_ev.scope(body)
+        self.env.update(i_ev.env)
+
+    def range(self, tree):
+        for e in tree.children:
+            if e is None: continue
+            v = self.visit(e)
+            if not checkType("Int", v): self.typeError("Int", v)
+        return "Int[]"
+
     
     def notexpr(self, tree):
         e = tree.children[0]
@@ -529,9 +1453,123 @@ class TypeChecker(Interpreter):
 
 
 
-class Evaluator(Interpreter): 
-    def __init__(self, o_env = None):
+def memoKey(values):
+    # Values of different types must not share an entry, even though
+    # 1 == 1.0 == True in Python. Lists can not be keys
+    key = []
+    for value in values:
+        t = type(value)
+        if t is tuple:
+            k = memoKey(value)
+            if k == None: return None
+            key.append((t, k))
+        elif t is list or t is ndarray or t is ListView or t is dict or t is set: return None
+        elif t is Rope: key.append((str, str(value)))
+        else: key.append((t, value))
+    return tuple(key)
+
+# Specialized nodes, with the node they specialize, its operator and the
+# types of the operands they are specialized for
+quickNodes = {
+    "addInts": ("addexpr", "+", int, int),
+    "subInts": ("addexpr", "-", int, int),
+    "addFloats": ("addexpr", "+", float, float),
+    "subFloats": ("addexpr", "-", float, float),
+    "addStrings": ("addexpr", "+", str, str),
+    "mulInts": ("mulexpr", "*", int, int),
+    "mulFloats": ("mulexpr", "*", float, float),
+    "lessInts": ("compexpr", "<", int, int),
+    "lessEqInts": ("compexpr", "<=", int, int),
+    "greaterInts": ("compexpr", ">", int, int),
+    "greaterEqInts": ("compexpr", ">=", int, int),
+    "eqInts": ("eqexpr", "==", int, int),
+    "notEqInts": ("eqexpr", "!=", int, int),
+    "listEntry": ("getentryexpr", None, list, int),
+}
+quickNames = dict([(v, k) for (k, v) in quickNodes.items()])
+quickGeneric = set([v[0] for v in quickNodes.values()])
+
+# Fused nodes the optimizer makes of common statement patterns, with the
+# node they replace
+fusedNodes = {
+    "incVar": "assignvar",
+    "decVar": "assignvar",
+    "addEntry": "assignvar",
+    "addEntryLeft": "assignvar",
+    "appendVar": "assignvar",
+    "putVar": "assignvar",
+    "setVar": "assignvar",
+    "lessVars": "compexpr",
+    "lessConst": "compexpr",
+    "lessSize": "compexpr",
+}
+
+def genericData(tree):
+    if tree.data in quickNodes: return quickNodes[tree.data][0]
+    elif tree.data in fusedNodes: return fusedNodes[tree.data]
+    return tree.data
+
+class Runtime:
+    def __init__(self, memoSize = 4096, callDepth = 30, hotCalls = 100):
+        self.memoSize = memoSize
+        self.callDepth = callDepth
+        self.hotCalls = hotCalls
+        self.depth = 0
+        self.calls = {}
+        self.promoted = []
+        self.quickCounts = {}
+        self.memo = {}
+        self.memoNames = {}
+        self.memoHits = {}
+        self.memoDeps = {}
+
+    def getMemo(self, key, name, deps):
+        if key not in self.memo:
+            self.memo[key] = OrderedDict()
+            self.memoNames[key] = name
+            self.memoHits[key] = [0, 0]
+            for (dep, depKey) in deps:
+                self.memoDeps.setdefault(dep, []).append((key, depKey))
+        return self.memo[key]
+
+    def hotCode(self, name, fun):
+        # Counts the calls of each function and compiles it once it has been
+        # called hotCalls times. Until then the tree is evaluated
+        key = funKeyOf(fun)
+        entry = self.calls.get(id(key))
+        if entry is None:
+            entry = [0, None, key]
+            self.calls[id(key)] = entry
+        elif entry[1] is not None: return entry[1]
+        entry[0] += 1
+        if self.hotCalls is None or entry[0] < self.hotCalls: return None
+        start = time.perf_counter()
+        entry[1] = compileFun(fun)
+        self.promoted.append((name, entry[0], time.perf_counter() - start))
+        return entry[1]
+
+    def declared(self, name, key):
+        # A function a memoized function depends on was declared again, so
+        # its results can not be trusted anymore
+        for (memoKey, depKey) in self.memoDeps.get(name, []):
+            if key is not depKey.key and self.memo[memoKey] != None:
+                self.memo[memoKey] = None
+
+    def report(self):
+        lines = []
+        for (key, name) in self.memoNames.items():
+            (hits, misses) = self.memoHits[key]
+            lines.append("Memoized %s: %d hits, %d misses" % (name, hits, misses))
+        for (name, (nodes, deopts)) in self.quickCounts.items():
+            lines.append("Specialized %d nodes to %s, %d deoptimized" % (nodes, name, deopts))
+        for (name, calls, seconds) in self.promoted:
+            lines.append("Compiled %s after %d calls in %.3f ms" % (name, calls, seconds * 1000))
+        return lines
+
+class Evaluator(Dispatcher): 
+    def __init__(self, o_env = None, rt = None):
         self.env = Env(o_env)
+        self.rt = rt if rt != None else Runtime()
     
     def addVar(self, name, value):
         self.env.n_varEnv[name] = value
@@ -546,6 +1584,7 @@ class Evaluator(Interpreter):
     
     def addFun(self, name, args, body=None, r=None, type="Void"):
         self.env.n_funEnv[name] = (type, args, body, r)
+        if name in self.rt.memoDeps: self.rt.declared(name, funKeyOf((type, args, body, r)))
 
     def getFun(self, name):
         if (name in self.env.n_funEnv): return self.env.n_funEnv[name]
@@ -566,16 +1605,93 @@ class Evaluator(Interpreter):
             value = self.visit(content)
             values.append(value)
         return tuple(values)
+
+    def map(self, tree):
+        contents = tree.children
+        values = {}
+        for i in range(0, len(contents), 2):
+            values[keyValue(self.visit(contents[i]))] = self.visit(contents[i + 1])
+        return values
+
+    def mapget(self, tree):
+        (e1, e2) = tree.children
+        return getValue(self.visit(e1), self.visit(e2))
+
+    def mapEntry(self, tree):
+        # m[k]. The key goes first, like the index of getentryexpr
+        (e1, e2) = tree.children
+        k = self.visit(e2)
+        return getValue(self.visit(e1), k)
+
+    def maphas(self, tree):
+        (e1, e2) = tree.children
+        return self.visit(e2) in self.visit(e1)
+
+    def mapput(self, tree):
+        (e1, e2, e3) = tree.children
+        return putValue(self.visit(e1), self.visit(e2), self.visit(e3), False)
+
+    def mapkeys(self, tree):
+        return list(self.visit(tree.children[0]))
+
+    def set(self, tree):
+        return set([keyValue(self.visit(content)) for content in tree.children])
+
+    def contains(self, tree):
+        (e1, e2) = tree.children
+        return self.visit(e2) in self.visit(e1)
+
+    def setop(self, tree):
+        (name, e1, e2) = tree.children
+        return setValue(name, self.visit(e1), self.visit(e2), False)
+
+    def matrix(self, tree):
+        return matrixValue(self.visit(tree.children[0]))
+
+    def matmul(self, tree):
+        (e1, e2) = tree.children
+        return matmulValue(self.visit(e1), self.visit(e2))
+
+    def transpose(self, tree):
+        return transposeValue(self.visit(tree.children[0]))
+
+    def dot(self, tree):
+        (e1, e2) = tree.children
+        return dotValue(self.visit(e1), self.visit(e2))
+
+    def matrow(self, tree):
+        (e1, e2) = tree.children
+        return rowValue(self.visit(e1), self.visit(e2))
+
+    def matcol(self, tree):
+        (e1, e2) = tree.children
+        return colValue(self.visit(e1), self.visit(e2))
+
+    def matrows(self, tree):
+        return shapeOf(self.visit(tree.children[0]))[0]
+
+    def matcols(self, tree):
+        return shapeOf(self.visit(tree.children[0]))[1]
     
     def getentryexpr(self, tree):
         (e1, e2) = tree.children
         i = self.visit(e2)
         list = self.visit(e1)
+        try: tree.quick
+        except AttributeError: self.quicken(tree, None, list, i)
         if (i < len(list) and i >= 0) or (i >= -len(list) and i < 0): 
-            if isinstance(list, str): return str(list[i])
+            if isinstance(list, str) or type(list) is Rope: return str(list[i])
+            elif type(list) is ndarray: return list[i].item() if list.ndim == 1 else list[i]
             else: return list[i]
         else: raise Exception("%s is out of bounds: %s" %(i, list))
 
+    def sliceexpr(self, tree):
+        (e1, e2, e3) = tree.children
+        list = self.visit(e1)
+        a = None if e2 is None else self.visit(e2)
+        b = None if e3 is None else self.visit(e3)
+        return sliceValue(list, a, b)
+
     def int(self, tree):
         value = tree.children[0]
         return int(value)
@@ -587,11 +1703,39 @@ class Evaluator(Interpreter):
     def string(self, tree):
         value = tree.children[0]
         return str(value).strip("\"")
+
+    def const(self, tree):
+        return tree.children[0]
+
+    def hoisted(self, tree):
+        i_ev = Evaluator(self.env, self.rt)
+        for e in tree.children:
+            i_ev.visit(e)
+        self.env.update(i_ev.env)
+
+    def hoistvar(self, tree):
+        (name, e) = tree.children
+        self.addVar(name, self.visit(e))
+
+    def inlined(self, tree):
+        (name, key, call, params, temps, argsv, body, e) = tree.children
+        try: fun = self.getFun(name)
+        except KeyError: return self.visit(call)
+        # The function may have been declared again since it was inlined
+        if funKeyOf(fun) is not key.key: return self.visit(call)
+        argsvalues = self.visit(argsv)
+        for i in range(len(params)):
+            self.addVar(params[i], argsvalues[i])
+        if body is not None: self.visit(body)
+        value = None
+        if e is not None: value = self.visit(e)
+        for temp in temps:
+            self.env.n_varEnv.pop(temp, None)
+        return value
     
     def bool(self, tree):
         value = tree.children[0]
-        if value == "True": return "True"
-        else: return "False"
+        return value == "True"
 
     def negative(self, tree):
         value = tree.children[0]
@@ -607,6 +1751,18 @@ class Evaluator(Interpreter):
         self.updateVar(name, self.visit(value))
         #self.env.env[name] = self.visit(value)
 
+    def setentry(self, tree):
+        # l[i] = e, which changes l in place when nothing else holds it
+        children = tree.children
+        name = children[0]
+        v = self.visit(children[-1])
+        indices = [self.visit(e) for e in children[1:-1]]
+        value = self.getVar(name)
+        owned = localRefs != None and refCount(value) == localRefs + self.env.holders(name, value)
+        self.updateVar(name, setEntryValue(value, indices, v, owned, tree.data == "setMatrix"))
+
+    setMatrix = setentry
+
     def var(self, tree):
         name = tree.children[0]
         return self.getVar(name)
@@ -633,55 +1789,322 @@ class Evaluator(Interpreter):
     
     def runfun(self, tree):
         (name, argsv) = tree.children
-        (type, argslist, body, r) = self.getFun(name)
+        fun = self.getFun(name)
         argsvalues = self.visit(argsv)
-        i_ev = Evaluator(self.env)
-        for i in range(len(argslist)):
-            (argtype, argname) = argslist[i]
-            argvalue = argsvalues[i]
-            i_ev.addVar(argname, argvalue)
-        if type != "Void":
-            if body != None:
-                i_ev.visit(body)
-            value = i_ev.visit(r)
-            self.env.update(i_ev.env)
+        return self.callFun(fun, argsvalues, name)
+
+    def memocall(self, tree):
+        (name, call, key, deps) = tree.children
+        fun = self.getFun(name)
+        if funKeyOf(fun) is not key.key: return self.visit(call)
+        memo = self.rt.getMemo(key, name, deps)
+        argsvalues = self.visit(call.children[1])
+        (found, k, value) = self.memoGet(key, memo, argsvalues)
+        if found: return value
+        value = self.callFun(fun, argsvalues, name)
+        self.memoPut(key, k, value)
+        return value
+
+    def memoGet(self, key, memo, argsvalues):
+        k = memoKey(argsvalues) if memo != None else None
+        if k == None: return (False, None, None)
+        counts = self.rt.memoHits[key]
+        if k in memo:
+            counts[0] += 1
+            memo.move_to_end(k)
+            return (True, k, memo[k])
+        counts[1] += 1
+        return (False, k, None)
+
+    def memoPut(self, key, k, value):
+        # The call may have declared a function it depends on
+        memo = self.rt.memo[key]
+        if k != None and memo != None:
+            memo[k] = value
+            if len(memo) > self.rt.memoSize: memo.popitem(last=False)
+
+    def callFun(self, fun, argsvalues, name):
+        # Past callDepth nested calls, or when deeply nested bodies already
+        # used half of the Python stack, the rest of the calls run on an
+        # explicit stack
+        if self.rt.depth >= self.rt.callDepth or stackAbove(sys.getrecursionlimit() // 2):
+            return self.trampoline(self.g_call(fun, argsvalues, name))
+        self.rt.depth += 1
+        try:
+            env = self.env
+            skip = None
+            while True:
+                (type, argslist, body, r) = fun
+                i_ev = Evaluator(env, self.rt)
+                for i in range(len(argslist)):
+                    i_ev.addVar(argslist[i][1], argsvalues[i])
+                code = self.rt.hotCode(name, fun)
+                if code is not None:
+                    (bodyf, rf, argsf) = code
+                    if bodyf is not None: bodyf(i_ev)
+                    if argsf is None:
+                        value = rf(i_ev) if rf is not None else None
+                        break
+                    name = r.children[0].children[0]
+                    fun = i_ev.getFun(name)
+                    argsvalues = argsf(i_ev)
+                    (env, skip) = tailEnv(i_ev.env, skip)
+                    continue
+                if body is not None: i_ev.visit(body)
+                if r is None:
+                    value = None
+                    break
+                e = r.children[0]
+                if e.data != "runfun":
+                    value = i_ev.visit(r)
+                    break
+                # A call in return position replaces the current call
+                (name, argsv) = e.children
+                fun = i_ev.getFun(name)
+                argsvalues = i_ev.visit(argsv)
+                (env, skip) = tailEnv(i_ev.env, skip)
+            self.env.update(i_ev.env, skip)
             return value
-        i_ev.visit(body)
-        self.env.update(i_ev.env)
+        finally:
+            self.rt.depth -= 1
 
-    def returnfun(self, tree):
-        e = tree.children[0]
-        return self.visit(e)
+    def trampoline(self, gen):
+        # Generators yield the generator of a call they wait for and get the
+        # value it returns sent back
+        stack = [gen]
+        value = None
+        while True:
+            try:
+                call = stack[-1].send(value)
+            except StopIteration as e:
+                stack.pop()
+                if len(stack) == 0: return e.value
+                value = e.value
+                continue
+            stack.append(call)
+            value = None
 
-    def funargsdecl(self, tree):
-        args = tree.children
-        arglist = []
-        for arg in args:
-            (type, name) = self.visit(arg)
-            arglist.append((type, name))
-        return arglist
-    
-    def funargs(self, tree):
-        args = tree.children
-        arglist = []
-        for arg in args:
-            value = self.visit(arg)
-            arglist.append(value)
-        return arglist
+    def gen(self, tree):
+        # Looked up on the class, since Interpreter answers every missing
+        # attribute of an instance with __default__
+        f = getattr(Evaluator, "g_" + tree.data, None)
+        if f is None: return self.g_generic(tree)
+        return f(self, tree)
 
-    
-    def addexpr(self, tree):
-        (e1, e2, e3) = tree.children
-        v1 = self.visit(e1)
-        v3 = self.visit(e3)
-        if (e2 == '+'):
-            return v1 + v3
-        return v1 - v3
-    
+    def g_visit(self, tree):
+        if hasCalls(tree): return (yield from self.gen(tree))
+        return self.visit(tree)
+
+    def g_generic(self, tree):
+        # Evaluates the children first and gives their values to the usual
+        # handler. Entries are evaluated before the list, like getentryexpr
+        children = tree.children[:]
+        order = range(len(children))
+        if tree.data in ("getentryexpr", "mapEntry"): order = reversed(order)
+        for i in order:
+            child = children[i]
+            if isinstance(child, Tree) and child.data not in ("type", "listtype", "tupletype"):
+                children[i] = constTree((yield from self.g_visit(child)))
+        if tree.data not in quickNodes and tree.data not in quickGeneric: return self.visit(Tree(tree.data, children))
+        # The node of the body is specialized or deoptimized for the values,
+        # and the tree made for them only runs the generic handler, so that
+        # trips through here count like the nodes they stand for
+        v1 = children[0].children[0]
+        v2 = children[-1].children[0]
+        spec = quickNodes.get(tree.data)
+        if spec is not None:
+            if type(v1) is not spec[2] or type(v2) is not spec[3]:
+                self.rt.quickCounts[tree.data][1] += 1
+                tree.data = spec[0]
+        else:
+            try: tree.quick
+            except AttributeError: self.quicken(tree, str(children[1]) if len(children) == 3 else None, v1, v2)
+        generic = Tree(genericData(tree), children)
+        generic.quick = True
+        return self.visit(generic)
+
+    def g_runfun(self, tree):
+        (name, argsv) = tree.children
+        fun = self.getFun(name)
+        argsvalues = yield from self.g_visit(argsv)
+        return (yield self.g_call(fun, argsvalues, name))
+
+    def g_memocall(self, tree):
+        (name, call, key, deps) = tree.children
+        fun = self.getFun(name)
+        if funKeyOf(fun) is not key.key: return (yield from self.g_visit(call))
+        memo = self.rt.getMemo(key, name, deps)
+        argsvalues = yield from self.g_visit(call.children[1])
+        (found, k, value) = self.memoGet(key, memo, argsvalues)
+        if found: return value
+        value = yield self.g_call(fun, argsvalues, name)
+        self.memoPut(key, k, value)
+        return value
+
+    def g_call(self, fun, argsvalues, name):
+        env = self.env
+        skip = None
+        while True:
+            (type, argslist, body, r) = fun
+            i_ev = Evaluator(env, self.rt)
+            for i in range(len(argslist)):
+                i_ev.addVar(argslist[i][1], argsvalues[i])
+            # Compiled code calls on the Python stack, so it only runs here
+            # for functions that call nothing
+            code = self.rt.hotCode(name, fun)
+            if code is not None and not funCalls(fun):
+                (bodyf, rf, argsf) = code
+                if bodyf is not None: bodyf(i_ev)
+                value = rf(i_ev) if rf is not None else None
+                break
+            if body is not None: yield from i_ev.g_visit(body)
+            if r is None:
+                value = None
+                break
+            e = r.children[0]
+            if e.data != "runfun":
+                value = yield from i_ev.g_visit(r)
+                break
+            (name, argsv) = e.children
+            fun = i_ev.getFun(name)
+            argsvalues = yield from i_ev.g_visit(argsv)
+            (env, skip) = tailEnv(i_ev.env, skip)
+        self.env.update(i_ev.env, skip)
+        return value
+
+    def g_inlined(self, tree):
+        (name, key, call, params, temps, argsv, body, e) = tree.children
+        try: fun = self.getFun(name)
+        except KeyError: return (yield from self.g_visit(call))
+        if funKeyOf(fun) is not key.key: return (yield from self.g_visit(call))
+        argsvalues = yield from self.g_visit(argsv)
+        for i in range(len(params)):
+            self.addVar(params[i], argsvalues[i])
+        if body is not None: yield from self.g_visit(body)
+        value = None
+        if e is not None: value = yield from self.g_visit(e)
+        for temp in temps:
+            self.env.n_varEnv.pop(temp, None)
+        return value
+
+    def g_andexpr(self, tree):
+        (e1, e2) = tree.children
+        v1 = yield from self.g_visit(e1)
+        if v1 is False: return False
+        elif v1 is not True: raise Exception("Value is not a BOOLEAN: %s" % v1)
+        v2 = yield from self.g_visit(e2)
+        if type(v2) is not bool: raise Exception("Value is not a BOOLEAN: %s" % v2)
+        return v2
+
+    def g_orexpr(self, tree):
+        (e1, e2) = tree.children
+        v1 = yield from self.g_visit(e1)
+        if v1 is True: return True
+        elif v1 is not False: raise Exception("Value is not a BOOLEAN: %s" % v1)
+        v2 = yield from self.g_visit(e2)
+        if type(v2) is not bool: raise Exception("Value is not a BOOLEAN: %s" % v2)
+        return v2
+
+    def g_ifexpr(self, tree):
+        exprs = tree.children
+        i = 0
+        lenght = len(exprs)-1
+        while i<lenght:
+            v1 = yield from self.g_visit(exprs[i])
+            if v1 is True:
+                yield from self.g_scope(exprs[i+1])
+                i = lenght+1
+            else: i=i+2
+        if (i == lenght):
+            yield from self.g_scope(exprs[i])
+
+    def g_branch(self, tree):
+        yield from self.g_scope(tree.children[0])
+
+    def g_scope(self, tree):
+        if not declares(tree): return (yield from self.g_visit(tree))
+        i_ev = Evaluator(self.env, self.rt)
+        yield from i_ev.g_visit(tree)
+        self.env.update(i_ev.env)
+
+    def g_switch(self, tree):
+        (e, table, keyType, other, chain) = tree.children
+        v = self.visit(e)
+        t = type(v)
+        if t is not keyType and (keyType is not int or t is not float): return (yield from self.g_visit(chain))
+        i = table.get(v, other)
+        if i is None: return
+        yield from self.g_scope(chain.children[i])
+
+    def g_whileexpr(self, tree):
+        (cond, e) = tree.children
+        while (yield from self.g_visit(cond)) is True:
+            yield from self.g_scope(e)
+
+    def g_forexpr(self, tree):
+        (e1, e2, e3, e4) = tree.children
+        i_ev = Evaluator(self.env, self.rt)
+        yield from i_ev.g_visit(e1)
+        while (yield from i_ev.g_visit(e2)) is True:
+            yield from i_ev.g_scope(e4)
+            yield from i_ev.g_visit(e3)
+        self.env.update(i_ev.env)
+
+    def g_foreach(self, tree):
+        (type, name, e, body) = tree.children
+        values = iterValues((yield from self.g_visit(e)))
+        i_ev = Evaluator(self.env, self.rt)
+        env = i_ev.env.n_varEnv
+        for value in values:
+            env[name] = value
+            yield from i_ev.g_scope(body)
+        self.env.update(i_ev.env)
+
+    def g_hoisted(self, tree):
+        i_ev = Evaluator(self.env, self.rt)
+        for e in tree.children:
+            yield from i_ev.g_visit(e)
+        self.env.update(i_ev.env)
+
+    def returnfun(self, tree):
+        e = tree.children[0]
+        return self.visit(e)
+
+    def funargsdecl(self, tree):
+        args = tree.children
+        arglist = []
+        for arg in args:
+            (type, name) = self.visit(arg)
+            arglist.append((type, name))
+        return arglist
+    
+    def funargs(self, tree):
+        args = tree.children
+        arglist = []
+        for arg in args:
+            value = self.visit(arg)
+            arglist.append(value)
+        return arglist
+
+    
+    def addexpr(self, tree):
+        (e1, e2, e3) = tree.children
+        v1 = self.visit(e1)
+        v3 = self.visit(e3)
+        try: tree.quick
+        except AttributeError: self.quicken(tree, str(e2), v1, v3)
+        if type(v1) in listTypes or type(v3) in listTypes: return vectorValue(str(e2), v1, v3)
+        if (e2 == '+'):
+            return joinStrings(v1, v3)
+        return v1 - v3
+    
     def mulexpr(self, tree):
         (e1, e2, e3) = tree.children
         v1 = self.visit(e1)
         v3 = self.visit(e3)
+        try: tree.quick
+        except AttributeError: self.quicken(tree, str(e2), v1, v3)
+        if type(v1) in listTypes or type(v3) in listTypes: return vectorValue(str(e2), v1, v3)
         if (e2 == '*'):
             return v1 * v3
         return v1 / v3
@@ -690,6 +2113,7 @@ class Evaluator(Interpreter):
         (e1, e2) = tree.children
         v1 = self.visit(e1)
         v2 = self.visit(e2)
+        if type(v1) in listTypes or type(v2) in listTypes: return vectorValue("^", v1, v2)
         return v1**v2
     
     def rootexpr(self, tree):
@@ -697,6 +2121,33 @@ class Evaluator(Interpreter):
         v1 = self.visit(e1)
         v2 = self.visit(e2)
         return v1**(1/v2)
+
+    def addVector(self, tree):
+        (e1, e2, e3) = tree.children
+        v1 = self.visit(e1)
+        v3 = self.visit(e3)
+        return vectorValue(str(e2), v1, v3)
+
+    mulVector = addVector
+
+    def powVector(self, tree):
+        (e1, e2) = tree.children
+        v1 = self.visit(e1)
+        v2 = self.visit(e2)
+        return vectorValue("^", v1, v2)
+
+    def concatLists(self, tree):
+        (e1, e2, e3) = tree.children
+        v1 = self.visit(e1)
+        v3 = self.visit(e3)
+        return concatValues(v1, v3)
+
+    def power(self, tree):
+        (e, n) = tree.children
+        return powerValue(self.visit(e), n)
+
+    def sqrt(self, tree):
+        return sqrtValue(self.visit(tree.children[0]))
     
     def divexpr(self, tree):
         (e1, e2) = tree.children
@@ -714,34 +2165,30 @@ class Evaluator(Interpreter):
         (e1, e2, e3) = tree.children
         v1 = self.visit(e1)
         v3 = self.visit(e3)
-        if (e2 == "=="):
-            if (v1 == v3): return "True"
-            else: return "False"
-        else:
-            if (v1 == v3): return "False"
-            else: return "True"
+        try: tree.quick
+        except AttributeError: self.quicken(tree, str(e2), v1, v3)
+        if (e2 == "=="): return isEqual(v1, v3)
+        else: return not isEqual(v1, v3)
         
     def compexpr(self, tree):
         (e1, e2, e3) = tree.children
         v1 = self.visit(e1)
         v3 = self.visit(e3)
-        if (e2 == ">="):
-            if (v1 >= v3): return "True"
-            else: return "False"
-        elif (e2 == "<="):
-            if (v1 <= v3): return "True"
-            else: return "False"
-        elif (e2 == "<"):
-            if (v1 < v3): return "True"
-            else: return "False"
-        else:
-            if (v1 > v3): return "True"
-            else: return "False"
+        try: tree.quick
+        except AttributeError: self.quicken(tree, str(e2), v1, v3)
+        if (e2 == ">="): return v1 >= v3
+        elif (e2 == "<="): return v1 <= v3
+        elif (e2 == "<"): return v1 < v3
+        else: return v1 > v3
         
     def size(self, tree):
         e = tree.children[0]
         v = self.visit(e)
         return len(v)
+
+    def reduction(self, tree):
+        (name, e) = tree.children
+        return reductions[name](self.visit(e))
     
     def ifexpr(self, tree):
         exprs = tree.children
@@ -750,96 +2197,2407 @@ class Evaluator(Interpreter):
         while i<lenght:
             e1 = exprs[i]
             v1 = self.visit(e1)
-            if (v1 == "True"):
+            if v1 is True:
                 e2 = exprs[i+1]
-                i_ev = Evaluator(self.env)
-                i_ev.visit(e2)
-                self.env.update(i_ev.env)
+                self.scope(e2)
                 i = lenght+1
             else: i=i+2
         if (i == lenght):
             e = exprs[i]
-            i_ev = Evaluator(self.env)
-            i_ev.visit(e)
-            self.env.update(i_ev.env)
+            self.scope(e)
+
+    def scope(self, tree):
+        # Blocks that declare nothing run in the scope around them
+        if not declares(tree): return self.visit(tree)
+        i_ev = Evaluator(self.env, self.rt)
+        i_ev.visit(tree)
+        self.env.update(i_ev.env)
+
+    def branch(self, tree):
+        self.scope(tree.children[0])
     
+    def switch(self, tree):
+        # Values of other types than the constants go through the chain
+        (e, table, keyType, other, chain) = tree.children
+        v = self.visit(e)
+        t = type(v)
+        if t is not keyType and (keyType is not int or t is not float): return self.visit(chain)
+        i = table.get(v, other)
+        if i is None: return
+        self.scope(chain.children[i])
+
     def whileexpr(self, tree):
         (cond, e) = tree.children
-        while self.visit(cond) == "True":
-            i_ev = Evaluator(self.env)
-            i_ev.visit(e)
-            self.env.update(i_ev.env)
+        while self.visit(cond) is True:
+            self.scope(e)
     
     def forexpr(self, tree):
         (e1, e2, e3, e4) = tree.children
-        i_ev = Evaluator(self.env)
+        i_ev = Evaluator(self.env, self.rt)
         i_ev.visit(e1)
-        while i_ev.visit(e2) == "True":
-            ii_ev = Evaluator(i_ev.env)
-            ii_ev.visit(e4)
-            i_ev.env.update(ii_ev.env)
+        while i_ev.visit(e2) is True:
+            i_ev.scope(e4)
             i_ev.visit(e3)
         self.env.update(i_ev.env)
 
+    def foreach(self, tree):
+        (type, name, e, body) = tree.children
+        values = iterValues(self.visit(e))
+        i_ev = Evaluator(self.env, self.rt)
+        env = i_ev.env.n_varEnv
+        for value in values:
+            env[name] = value
+            i_ev.scope(body)
+        self.env.update(i_ev.env)
+
+    def range(self, tree):
+        (e1, e2, e3) = tree.children
+        a = self.visit(e1)
+        b = self.visit(e2)
+        return rangeValue(a, b, None if e3 is None else self.visit(e3))
+
     
+    def incVar(self, tree):
+        # x = x + c
+        (name, e) = tree.children
+        env = self.env
+        if name in env.n_varEnv: env.n_varEnv[name] = env.n_varEnv[name] + e.children[2].children[0]
+        else: env.o_varEnv[name] = env.o_varEnv[name] + e.children[2].children[0]
+
+    def decVar(self, tree):
+        # x = x - c
+        (name, e) = tree.children
+        env = self.env
+        if name in env.n_varEnv: env.n_varEnv[name] = env.n_varEnv[name] - e.children[2].children[0]
+        else: env.o_varEnv[name] = env.o_varEnv[name] - e.children[2].children[0]
+
+    def appendVar(self, tree):
+        # x = x + e, where e can not change x
+        (name, e) = tree.children
+        value = self.getVar(name)
+        other = self.visit(e.children[2])
+        owned = localRefs != None and refCount(value) == localRefs + self.env.holders(name, value)
+        self.updateVar(name, appendValue(value, other, owned))
+
+    def putVar(self, tree):
+        # x = put(x; k; v), where k and v can not change x
+        (name, e) = tree.children
+        value = self.getVar(name)
+        k = self.visit(e.children[1])
+        v = self.visit(e.children[2])
+        owned = localRefs != None and refCount(value) == localRefs + self.env.holders(name, value)
+        self.updateVar(name, putValue(value, k, v, owned))
+
+    def setVar(self, tree):
+        # x = union(x; e) and the like, where e can not change x
+        (name, e) = tree.children
+        value = self.getVar(name)
+        other = self.visit(e.children[2])
+        owned = localRefs != None and refCount(value) == localRefs + self.env.holders(name, value)
+        self.updateVar(name, setValue(e.children[0], value, other, owned))
+
+    def varEntry(self, tree):
+        # l[i] with variables for l and i
+        (e1, e2) = tree.children
+        i = self.getVar(e2.children[0])
+        list = self.getVar(e1.children[0])
+        if (i < len(list) and i >= 0) or (i >= -len(list) and i < 0):
+            if isinstance(list, str) or type(list) is Rope: return str(list[i])
+            elif type(list) is ndarray: return list[i].item() if list.ndim == 1 else list[i]
+            else: return list[i]
+        else: raise Exception("%s is out of bounds: %s" %(i, list))
+
+    def addEntry(self, tree):
+        # x = x + l[i]
+        (name, e) = tree.children
+        value = self.getVar(name)
+        self.updateVar(name, value + self.varEntry(e.children[2]))
+
+    def addEntryLeft(self, tree):
+        # x = l[i] + x
+        (name, e) = tree.children
+        entry = self.varEntry(e.children[0])
+        self.updateVar(name, entry + self.getVar(name))
+
+    def lessVars(self, tree):
+        (e1, e2, e3) = tree.children
+        return self.getVar(e1.children[0]) < self.getVar(e3.children[0])
+
+    def lessConst(self, tree):
+        (e1, e2, e3) = tree.children
+        return self.getVar(e1.children[0]) < e3.children[0]
+
+    def lessSize(self, tree):
+        (e1, e2, e3) = tree.children
+        return self.getVar(e1.children[0]) < len(self.getVar(e3.children[0].children[0]))
+
+    def quicken(self, tree, op, v1, v2):
+        # A node is specialized once, for the types of the operands it sees
+        # first
+        tree.quick = True
+        name = quickNames.get((tree.data, op, type(v1), type(v2)))
+        if name is None: return
+        tree.data = name
+        self.rt.quickCounts.setdefault(name, [0, 0])[0] += 1
+
+    def deopt(self, tree, v1, v2):
+        # Operands of other types turn the node back into the generic node
+        # for good, which gives the result for the values already computed
+        self.rt.quickCounts[tree.data][1] += 1
+        tree.data = quickNodes[tree.data][0]
+        children = tree.children[:]
+        children[0] = constTree(v1)
+        children[-1] = constTree(v2)
+        generic = Tree(tree.data, children)
+        generic.quick = True
+        return self.visit(generic)
+
+    def addInts(self, tree):
+        (e1, e2, e3) = tree.children
+        v1 = self.visit(e1)
+        v3 = self.visit(e3)
+        if type(v1) is int and type(v3) is int: return v1 + v3
+        return self.deopt(tree, v1, v3)
+
+    def subInts(self, tree):
+        (e1, e2, e3) = tree.children
+        v1 = self.visit(e1)
+        v3 = self.visit(e3)
+        if type(v1) is int and type(v3) is int: return v1 - v3
+        return self.deopt(tree, v1, v3)
+
+    def addFloats(self, tree):
+        (e1, e2, e3) = tree.children
+        v1 = self.visit(e1)
+        v3 = self.visit(e3)
+        if type(v1) is float and type(v3) is float: return v1 + v3
+        return self.deopt(tree, v1, v3)
+
+    def subFloats(self, tree):
+        (e1, e2, e3) = tree.children
+        v1 = self.visit(e1)
+        v3 = self.visit(e3)
+        if type(v1) is float and type(v3) is float: return v1 - v3
+        return self.deopt(tree, v1, v3)
+
+    def addStrings(self, tree):
+        (e1, e2, e3) = tree.children
+        v1 = self.visit(e1)
+        v3 = self.visit(e3)
+        if type(v1) is str and type(v3) is str:
+            if len(v1) < ropeSize: return v1 + v3
+            return Rope([v1, v3], len(v1) + len(v3))
+        return self.deopt(tree, v1, v3)
+
+    def mulInts(self, tree):
+        (e1, e2, e3) = tree.children
+        v1 = self.visit(e1)
+        v3 = self.visit(e3)
+        if type(v1) is int and type(v3) is int: return v1 * v3
+        return self.deopt(tree, v1, v3)
+
+    def mulFloats(self, tree):
+        (e1, e2, e3) = tree.children
+        v1 = self.visit(e1)
+        v3 = self.visit(e3)
+        if type(v1) is float and type(v3) is float: return v1 * v3
+        return self.deopt(tree, v1, v3)
+
+    def lessInts(self, tree):
+        (e1, e2, e3) = tree.children
+        v1 = self.visit(e1)
+        v3 = self.visit(e3)
+        if type(v1) is int and type(v3) is int: return v1 < v3
+        return self.deopt(tree, v1, v3)
+
+    def lessEqInts(self, tree):
+        (e1, e2, e3) = tree.children
+        v1 = self.visit(e1)
+        v3 = self.visit(e3)
+        if type(v1) is int and type(v3) is int: return v1 <= v3
+        return self.deopt(tree, v1, v3)
+
+    def greaterInts(self, tree):
+        (e1, e2, e3) = tree.children
+        v1 = self.visit(e1)
+        v3 = self.visit(e3)
+        if type(v1) is int and type(v3) is int: return v1 > v3
+        return self.deopt(tree, v1, v3)
+
+    def greaterEqInts(self, tree):
+        (e1, e2, e3) = tree.children
+        v1 = self.visit(e1)
+        v3 = self.visit(e3)
+        if type(v1) is int and type(v3) is int: return v1 >= v3
+        return self.deopt(tree, v1, v3)
+
+    def eqInts(self, tree):
+        (e1, e2, e3) = tree.children
+        v1 = self.visit(e1)
+        v3 = self.visit(e3)
+        if type(v1) is int and type(v3) is int: return v1 == v3
+        return self.deopt(tree, v1, v3)
+
+    def notEqInts(self, tree):
+        (e1, e2, e3) = tree.children
+        v1 = self.visit(e1)
+        v3 = self.visit(e3)
+        if type(v1) is int and type(v3) is int: return v1 != v3
+        return self.deopt(tree, v1, v3)
+
+    def listEntry(self, tree):
+        (e1, e2) = tree.children
+        i = self.visit(e2)
+        list = self.visit(e1)
+        if type(list) is not type([]) or type(i) is not int: return self.deopt(tree, list, i)
+        if (i < len(list) and i >= 0) or (i >= -len(list) and i < 0): return list[i]
+        else: raise Exception("%s is out of bounds: %s" %(i, list))
+
     def notexpr(self, tree):
         e = tree.children[0]
         v = self.visit(e)
-        if v == "False": return "True"
-        elif v == "True": return "False"
+        if v is False: return True
+        elif v is True: return False
         else: raise Exception("Value is not a BOOLEAN: %s" % v)
     
     def andexpr(self, tree):
         (e1, e2) = tree.children
         v1 = self.visit(e1)
+        if v1 is False: return False
+        elif v1 is not True: raise Exception("Value is not a BOOLEAN: %s" % v1)
         v2 = self.visit(e2)
-        if (v1 == "True") and (v2 == "True"): return "True"
-        elif (v1 != "True") and (v1 != "False") : raise Exception("Value is not a BOOLEAN: %s" % v1)
-        elif (v2 != "True") and (v2 != "False") : raise Exception("Value is not a BOOLEAN: %s" % v2)
-        else: return "False"
+        if type(v2) is not bool: raise Exception("Value is not a BOOLEAN: %s" % v2)
+        return v2
 
     def orexpr(self, tree):
         (e1, e2) = tree.children
         v1 = self.visit(e1)
+        if v1 is True: return True
+        elif v1 is not False: raise Exception("Value is not a BOOLEAN: %s" % v1)
         v2 = self.visit(e2)
-        if (v1 == "False") and (v2 == "False"): return "False"
-        elif (v1 != "True") and (v1 != "False") : raise Exception("Value is not a BOOLEAN: %s" % v1)
-        elif (v2 != "True") and (v2 != "False") : raise Exception("Value is not a BOOLEAN: %s" % v2)
-        else: return "True"
+        if type(v2) is not bool: raise Exception("Value is not a BOOLEAN: %s" % v2)
+        return v2
     
     def tostring(self, tree):
         e = tree.children[0]
         v = self.visit(e)
-        return str(v)
+        return showValue(v)
 
     def print(self, tree):
         value = self.visit(tree.children[0])
-        print(value)
+        print(showValue(value))
 
 
-def runCode(code, tc, ev):
-    tree = parser.parse(code)
-    tc.visit(tree)
-    ev.visit(tree)
+def compileFun(fun):
+    # The body, the return expression and, for a call in return position,
+    # its arguments, each as a function of the Evaluator of the call
+    (type, argslist, body, r) = fun
+    compiler = Compiler()
+    bodyf = compiler.visit(body) if body is not None else None
+    if r is None: return (bodyf, None, None)
+    e = r.children[0]
+    if e.data == "runfun": return (bodyf, None, compiler.visit(e.children[1]))
+    return (bodyf, compiler.visit(e), None)
 
-def execute(path, o_tc = TypeChecker(), o_ev = Evaluator()):
-    with open(path, "r") as file:
-        code = file.read()
-        close
-    i_tc = TypeChecker(o_tc.env)
-    i_ev = Evaluator(o_ev.env)
-    runCode(code, i_tc, i_ev)
-    o_tc.env.update(i_tc.env)
-    o_ev.env.update(i_ev.env)
+class Compiler(Dispatcher):
+    # Turns a tree into a closure that takes an Evaluator and does what
+    # visiting the tree with it does, without dispatching on every node
+    def __default__(self, tree):
+        return lambda ev: ev.visit(tree)
 
-if __name__ == '__main__':
-    tc = TypeChecker()
-    ev = Evaluator()
-    while True:
-        code = input('> ')
-        if code.strip() == "quit()":
-            break
-        try:
-            runCode(code, tc, ev)
+    def program(self, tree):
+        fs = [self.visit(e) for e in tree.children]
+        def f(ev):
+            for g in fs: g(ev)
+        return f
+
+    def block(self, tree):
+        g = self.visit(tree)
+        if not declares(tree): return g
+        def f(ev):
+            i_ev = Evaluator(ev.env, ev.rt)
+            g(i_ev)
+            ev.env.update(i_ev.env)
+        return f
+
+    def constant(self, value):
+        return lambda ev: value
+
+    def int(self, tree):
+        return self.constant(int(tree.children[0]))
+
+    def float(self, tree):
+        return self.constant(float(tree.children[0]))
+
+    def string(self, tree):
+        return self.constant(str(tree.children[0]).strip("\""))
+
+    def bool(self, tree):
+        return self.constant(tree.children[0] == "True")
+
+    def const(self, tree):
+        return self.constant(tree.children[0])
+
+    def list(self, tree):
+        fs = [self.visit(e) for e in tree.children]
+        return lambda ev: [g(ev) for g in fs]
+
+    def tuple(self, tree):
+        fs = [self.visit(e) for e in tree.children]
+        return lambda ev: tuple([g(ev) for g in fs])
+
+    def map(self, tree):
+        fs = [self.visit(e) for e in tree.children]
+        return lambda ev: dict([(keyValue(fs[i](ev)), fs[i + 1](ev)) for i in range(0, len(fs), 2)])
+
+    def mapget(self, tree):
+        (e1, e2) = tree.children
+        a = self.visit(e1)
+        b = self.visit(e2)
+        return lambda ev: getValue(a(ev), b(ev))
+
+    def mapEntry(self, tree):
+        (e1, e2) = tree.children
+        a = self.visit(e1)
+        b = self.visit(e2)
+        def f(ev):
+            k = b(ev)
+            return getValue(a(ev), k)
+        return f
+
+    def maphas(self, tree):
+        (e1, e2) = tree.children
+        a = self.visit(e1)
+        b = self.visit(e2)
+        def f(ev):
+            m = a(ev)
+            return b(ev) in m
+        return f
+
+    def mapput(self, tree):
+        (e1, e2, e3) = tree.children
+        a = self.visit(e1)
+        b = self.visit(e2)
+        c = self.visit(e3)
+        def f(ev):
+            m = a(ev)
+            k = b(ev)
+            return putValue(m, k, c(ev), False)
+        return f
+
+    def mapkeys(self, tree):
+        g = self.visit(tree.children[0])
+        return lambda ev: list(g(ev))
+
+    def set(self, tree):
+        fs = [self.visit(e) for e in tree.children]
+        return lambda ev: set([keyValue(g(ev)) for g in fs])
+
+    def contains(self, tree):
+        (e1, e2) = tree.children
+        a = self.visit(e1)
+        b = self.visit(e2)
+        def f(ev):
+            s = a(ev)
+            return b(ev) in s
+        return f
+
+    def setop(self, tree):
+        (name, e1, e2) = tree.children
+        a = self.visit(e1)
+        b = self.visit(e2)
+        def f(ev):
+            s = a(ev)
+            return setValue(name, s, b(ev), False)
+        return f
+
+    def unaryCall(self, tree, f):
+        g = self.visit(tree.children[0])
+        return lambda ev: f(g(ev))
+
+    def binaryCall(self, tree, f):
+        (e1, e2) = tree.children
+        a = self.visit(e1)
+        b = self.visit(e2)
+        def h(ev):
+            v1 = a(ev)
+            return f(v1, b(ev))
+        return h
+
+    def matrix(self, tree):
+        return self.unaryCall(tree, matrixValue)
+
+    def matmul(self, tree):
+        return self.binaryCall(tree, matmulValue)
+
+    def transpose(self, tree):
+        return self.unaryCall(tree, transposeValue)
+
+    def dot(self, tree):
+        return self.binaryCall(tree, dotValue)
+
+    def matrow(self, tree):
+        return self.binaryCall(tree, rowValue)
+
+    def matcol(self, tree):
+        return self.binaryCall(tree, colValue)
+
+    def matrows(self, tree):
+        return self.unaryCall(tree, lambda m: shapeOf(m)[0])
+
+    def matcols(self, tree):
+        return self.unaryCall(tree, lambda m: shapeOf(m)[1])
+
+    def funargs(self, tree):
+        return self.list(tree)
+
+    def returnfun(self, tree):
+        return self.visit(tree.children[0])
+
+    def var(self, tree):
+        name = tree.children[0]
+        def f(ev):
+            env = ev.env
+            if name in env.n_varEnv: return env.n_varEnv[name]
+            else: return env.o_varEnv[name]
+        return f
+
+    def vardecl(self, tree):
+        (type, name, value) = tree.children
+        g = self.visit(value)
+        def f(ev):
+            ev.env.n_varEnv[name] = g(ev)
+        return f
+
+    def assignvar(self, tree):
+        (name, value) = tree.children
+        g = self.visit(value)
+        def f(ev):
+            v = g(ev)
+            env = ev.env
+            if name in env.n_varEnv: env.n_varEnv[name] = v
+            else: env.o_varEnv[name] = v
+        return f
+
+    incVar = decVar = addEntry = addEntryLeft = assignvar
+
+    def setentry(self, tree):
+        children = tree.children
+        name = children[0]
+        g = self.visit(children[-1])
+        fs = [self.visit(e) for e in children[1:-1]]
+        floats = tree.data == "setMatrix"
+        def f(ev):
+            v = g(ev)
+            indices = [h(ev) for h in fs]
+            value = ev.getVar(name)
+            owned = localRefs != None and refCount(value) == localRefs + ev.env.holders(name, value)
+            ev.updateVar(name, setEntryValue(value, indices, v, owned, floats))
+        return f
+
+    setMatrix = setentry
+
+    def appendVar(self, tree):
+        (name, e) = tree.children
+        g = self.visit(e.children[2])
+        def f(ev):
+            value = ev.getVar(name)
+            other = g(ev)
+            owned = localRefs != None and refCount(value) == localRefs + ev.env.holders(name, value)
+            ev.updateVar(name, appendValue(value, other, owned))
+        return f
+
+    def putVar(self, tree):
+        (name, e) = tree.children
+        a = self.visit(e.children[1])
+        b = self.visit(e.children[2])
+        def f(ev):
+            value = ev.getVar(name)
+            k = a(ev)
+            v = b(ev)
+            owned = localRefs != None and refCount(value) == localRefs + ev.env.holders(name, value)
+            ev.updateVar(name, putValue(value, k, v, owned))
+        return f
+
+    def setVar(self, tree):
+        (name, e) = tree.children
+        op = e.children[0]
+        g = self.visit(e.children[2])
+        def f(ev):
+            value = ev.getVar(name)
+            other = g(ev)
+            owned = localRefs != None and refCount(value) == localRefs + ev.env.holders(name, value)
+            ev.updateVar(name, setValue(op, value, other, owned))
+        return f
+
+    def hoistvar(self, tree):
+        return self.vardecl(Tree("vardecl", [None] + tree.children))
+
+    def hoisted(self, tree):
+        return self.block(Tree("program", tree.children))
+
+    def runfun(self, tree):
+        (name, argsv) = tree.children
+        args = self.visit(argsv)
+        def f(ev):
+            fun = ev.getFun(name)
+            return ev.callFun(fun, args(ev), name)
+        return f
+
+    def memocall(self, tree):
+        (name, call, key, deps) = tree.children
+        args = self.visit(call.children[1])
+        callf = self.visit(call)
+        def f(ev):
+            fun = ev.getFun(name)
+            if funKeyOf(fun) is not key.key: return callf(ev)
+            memo = ev.rt.getMemo(key, name, deps)
+            argsvalues = args(ev)
+            (found, k, value) = ev.memoGet(key, memo, argsvalues)
+            if found: return value
+            value = ev.callFun(fun, argsvalues, name)
+            ev.memoPut(key, k, value)
+            return value
+        return f
+
+    def inlined(self, tree):
+        (name, key, call, params, temps, argsv, body, e) = tree.children
+        callf = self.visit(call)
+        args = self.visit(argsv)
+        bodyf = self.visit(body) if body is not None else None
+        ef = self.visit(e) if e is not None else None
+        def f(ev):
+            try: fun = ev.getFun(name)
+            except KeyError: return callf(ev)
+            if funKeyOf(fun) is not key.key: return callf(ev)
+            argsvalues = args(ev)
+            for i in range(len(params)):
+                ev.env.n_varEnv[params[i]] = argsvalues[i]
+            if bodyf is not None: bodyf(ev)
+            value = None
+            if ef is not None: value = ef(ev)
+            for temp in temps:
+                ev.env.n_varEnv.pop(temp, None)
+            return value
+        return f
+
+    def negative(self, tree):
+        g = self.visit(tree.children[0])
+        return lambda ev: -1 * g(ev)
+
+    def addexpr(self, tree):
+        (e1, e2, e3) = tree.children
+        a = self.visit(e1)
+        b = self.visit(e3)
+        op = str(e2)
+        # Nodes that are not specialized may see lists
+        if tree.data == "addexpr": return lambda ev: arithValue(op, a(ev), b(ev))
+        elif tree.data == "addStrings": return lambda ev: joinStrings(a(ev), b(ev))
+        elif e2 == "+": return lambda ev: a(ev) + b(ev)
+        return lambda ev: a(ev) - b(ev)
+
+    def mulexpr(self, tree):
+        (e1, e2, e3) = tree.children
+        a = self.visit(e1)
+        b = self.visit(e3)
+        op = str(e2)
+        if tree.data == "mulexpr": return lambda ev: arithValue(op, a(ev), b(ev))
+        elif e2 == "*": return lambda ev: a(ev) * b(ev)
+        return lambda ev: a(ev) / b(ev)
+
+    def expexpr(self, tree):
+        (e1, e2) = tree.children
+        a = self.visit(e1)
+        b = self.visit(e2)
+        return lambda ev: arithValue("^", a(ev), b(ev))
+
+    def rootexpr(self, tree):
+        (e1, e2) = tree.children
+        a = self.visit(e1)
+        b = self.visit(e2)
+        def f(ev):
+            v1 = a(ev)
+            return v1 ** (1 / b(ev))
+        return f
+
+    def addVector(self, tree):
+        (e1, e2, e3) = tree.children
+        a = self.visit(e1)
+        b = self.visit(e3)
+        op = str(e2)
+        return lambda ev: vectorValue(op, a(ev), b(ev))
+
+    mulVector = addVector
+
+    def powVector(self, tree):
+        (e1, e2) = tree.children
+        a = self.visit(e1)
+        b = self.visit(e2)
+        return lambda ev: vectorValue("^", a(ev), b(ev))
+
+    def concatLists(self, tree):
+        (e1, e2, e3) = tree.children
+        a = self.visit(e1)
+        b = self.visit(e3)
+        return lambda ev: concatValues(a(ev), b(ev))
+
+    def power(self, tree):
+        (e, n) = tree.children
+        g = self.visit(e)
+        return lambda ev: powerValue(g(ev), n)
+
+    def sqrt(self, tree):
+        g = self.visit(tree.children[0])
+        return lambda ev: sqrtValue(g(ev))
+
+    def divexpr(self, tree):
+        (e1, e2) = tree.children
+        a = self.visit(e1)
+        b = self.visit(e2)
+        def f(ev):
+            v1 = a(ev)
+            return int(v1 // b(ev))
+        return f
+
+    def modexpr(self, tree):
+        (e1, e2) = tree.children
+        a = self.visit(e1)
+        b = self.visit(e2)
+        return lambda ev: a(ev) % b(ev)
+
+    def eqexpr(self, tree):
+        (e1, e2, e3) = tree.children
+        a = self.visit(e1)
+        b = self.visit(e3)
+        if e2 == "==": return lambda ev: isEqual(a(ev), b(ev))
+        return lambda ev: not isEqual(a(ev), b(ev))
+
+    def compexpr(self, tree):
+        (e1, e2, e3) = tree.children
+        a = self.visit(e1)
+        b = self.visit(e3)
+        if e2 == ">=": return lambda ev: a(ev) >= b(ev)
+        elif e2 == "<=": return lambda ev: a(ev) <= b(ev)
+        elif e2 == "<": return lambda ev: a(ev) < b(ev)
+        return lambda ev: a(ev) > b(ev)
+
+    def size(self, tree):
+        g = self.visit(tree.children[0])
+        return lambda ev: len(g(ev))
+
+    def reduction(self, tree):
+        (name, e) = tree.children
+        f = reductions[name]
+        g = self.visit(e)
+        return lambda ev: f(g(ev))
+
+    def getentryexpr(self, tree):
+        (e1, e2) = tree.children
+        a = self.visit(e1)
+        b = self.visit(e2)
+        def f(ev):
+            i = b(ev)
+            list = a(ev)
+            if (i < len(list) and i >= 0) or (i >= -len(list) and i < 0):
+                if isinstance(list, str) or type(list) is Rope: return str(list[i])
+                elif type(list) is ndarray: return list[i].item() if list.ndim == 1 else list[i]
+                else: return list[i]
+            else: raise Exception("%s is out of bounds: %s" %(i, list))
+        return f
+
+    def sliceexpr(self, tree):
+        (e1, e2, e3) = tree.children
+        g = self.visit(e1)
+        a = (lambda ev: None) if e2 is None else self.visit(e2)
+        b = (lambda ev: None) if e3 is None else self.visit(e3)
+        return lambda ev: sliceValue(g(ev), a(ev), b(ev))
+
+    addInts = subInts = addFloats = subFloats = addStrings = addexpr
+    mulInts = mulFloats = mulexpr
+    lessInts = lessEqInts = greaterInts = greaterEqInts = compexpr
+    eqInts = notEqInts = eqexpr
+    listEntry = getentryexpr
+    lessVars = lessConst = lessSize = compexpr
+
+    def notexpr(self, tree):
+        g = self.visit(tree.children[0])
+        def f(ev):
+            v = g(ev)
+            if v is False: return True
+            elif v is True: return False
+            else: raise Exception("Value is not a BOOLEAN: %s" % v)
+        return f
+
+    def andexpr(self, tree):
+        (e1, e2) = tree.children
+        a = self.visit(e1)
+        b = self.visit(e2)
+        def f(ev):
+            v1 = a(ev)
+            if v1 is False: return False
+            elif v1 is not True: raise Exception("Value is not a BOOLEAN: %s" % v1)
+            v2 = b(ev)
+            if type(v2) is not bool: raise Exception("Value is not a BOOLEAN: %s" % v2)
+            return v2
+        return f
+
+    def orexpr(self, tree):
+        (e1, e2) = tree.children
+        a = self.visit(e1)
+        b = self.visit(e2)
+        def f(ev):
+            v1 = a(ev)
+            if v1 is True: return True
+            elif v1 is not False: raise Exception("Value is not a BOOLEAN: %s" % v1)
+            v2 = b(ev)
+            if type(v2) is not bool: raise Exception("Value is not a BOOLEAN: %s" % v2)
+            return v2
+        return f
+
+    def tostring(self, tree):
+        g = self.visit(tree.children[0])
+        return lambda ev: showValue(g(ev))
+
+    def print(self, tree):
+        g = self.visit(tree.children[0])
+        def f(ev):
+            print(showValue(g(ev)))
+        return f
+
+    def ifexpr(self, tree):
+        exprs = tree.children
+        conds = []
+        for i in range(0, len(exprs) - 1, 2):
+            conds.append((self.visit(exprs[i]), self.block(exprs[i+1])))
+        other = self.block(exprs[-1]) if len(exprs) % 2 == 1 else None
+        def f(ev):
+            for (cond, then) in conds:
+                if cond(ev) is True:
+                    then(ev)
+                    return
+            if other is not None: other(ev)
+        return f
+
+    def branch(self, tree):
+        return self.block(tree.children[0])
+
+    def switch(self, tree):
+        (e, table, keyType, other, chain) = tree.children
+        g = self.visit(e)
+        chainf = self.visit(chain)
+        blocks = dict([(i, self.block(chain.children[i])) for i in set(table.values()) | {other} if i is not None])
+        def f(ev):
+            v = g(ev)
+            t = type(v)
+            if t is not keyType and (keyType is not int or t is not float): return chainf(ev)
+            i = table.get(v, other)
+            if i is not None: blocks[i](ev)
+        return f
+
+    def whileexpr(self, tree):
+        (cond, e) = tree.children
+        condf = self.visit(cond)
+        body = self.block(e)
+        def f(ev):
+            while condf(ev) is True: body(ev)
+        return f
+
+    def forexpr(self, tree):
+        (e1, e2, e3, e4) = tree.children
+        init = self.visit(e1)
+        condf = self.visit(e2)
+        step = self.visit(e3)
+        body = self.block(e4)
+        def f(ev):
+            i_ev = Evaluator(ev.env, ev.rt)
+            init(i_ev)
+            while condf(i_ev) is True:
+                body(i_ev)
+                step(i_ev)
+            ev.env.update(i_ev.env)
+        return f
+
+    def foreach(self, tree):
+        (type, name, e, e4) = tree.children
+        g = self.visit(e)
+        body = self.block(e4)
+        def f(ev):
+            values = iterValues(g(ev))
+            i_ev = Evaluator(ev.env, ev.rt)
+            env = i_ev.env.n_varEnv
+            for value in values:
+                env[name] = value
+                body(i_ev)
+            ev.env.update(i_ev.env)
+        return f
+
+    def range(self, tree):
+        (e1, e2, e3) = tree.children
+        a = self.visit(e1)
+        b = self.visit(e2)
+        c = (lambda ev: None) if e3 is None else self.visit(e3)
+        def f(ev):
+            v1 = a(ev)
+            v2 = b(ev)
+            return rangeValue(v1, v2, c(ev))
+        return f
+
+def getStatements(tree):
+    if tree.data == "program": return tree.children
+    else: return [tree]
+
+def getFunTrees(env):
+    trees = []
+    for funs in getFuns(env).values():
+        for (params, body, r) in funs:
+            trees += [t for t in (body, r) if t != None]
+    return trees
+
+def getFuns(env):
+    funs = env.o_funEnv.copy()
+    funs.update(env.n_funEnv)
+    table = {}
+    for (name, (type, args, body, r)) in funs.items():
+        table[name] = [([argname for (argtype, argname) in args], body, r)]
+    return table
+
+def funParts(fun):
+    # Functions are either declarations from the program being optimized or
+    # (params, body, r) from the environment
+    if not isinstance(fun, Tree): return fun
+    if fun.data == "vfundecl":
+        (name, args, body) = fun.children
+        r = None
+    elif fun.data == "tfundecl": (type, name, args, body, r) = fun.children
+    else:
+        (type, name, args, r) = fun.children
+        body = None
+    return ([arg.children[1] for arg in args.children], body, r)
+
+def getFunDecls(tree):
+    table = {}
+    for node in tree.iter_subtrees():
+        if node.data in ("vfundecl", "tfundecl", "stfundecl"):
+            name = node.children[0] if node.data == "vfundecl" else node.children[1]
+            table.setdefault(name, []).append(node)
+    return table
+
+def assignedNames(trees):
+    names = set()
+    for tree in trees:
+        for node in tree.iter_subtrees():
+            if genericData(node) == "assignvar" or node.data in ("setentry", "setMatrix"): names.add(node.children[0])
+    return names
+
+def readNames(tree):
+    names = set()
+    for node in tree.iter_subtrees():
+        if node.data == "var": names.add(node.children[0])
+    return names
+
+def isConst(tree):
+    return isinstance(tree, Tree) and tree.data == "const"
+
+def constTree(value):
+    return Tree("const", [value])
+
+def scanEffects(tree, reads, writes, calls):
+    # Collects what a statement reads, assigns and calls, without looking
+    # into functions it declares. Returns whether it prints
+    prints = tree.data == "print"
+    # Temporaries made by the optimizer are always set before they are used
+    if tree.data == "var":
+        if tree.children[0][0] != "$": reads.add(tree.children[0])
+    elif genericData(tree) == "assignvar" or tree.data in ("setentry", "setMatrix"):
+        if tree.children[0][0] != "$": writes.add(tree.children[0])
+    elif tree.data == "runfun" or tree.data == "inlined": calls.add(tree.children[0])
+    elif tree.data in ("vfundecl", "tfundecl", "stfundecl"): return False
+    for child in tree.children:
+        if isinstance(child, Tree) and scanEffects(child, reads, writes, calls): prints = True
+    return prints
+
+def countNodes(tree):
+    if not isinstance(tree, Tree): return 0
+    n = 1
+    for child in tree.children:
+        n += countNodes(child)
+    return n
+
+class FunKey:
+    # Identifies the declaration an inlined call was taken from. Copies of
+    # the tree keep pointing at the same declaration
+    def __init__(self, key):
+        self.key = key
+
+    def __deepcopy__(self, memo):
+        return self
+
+def renameVars(tree, names):
+    if tree.data in ("var", "setentry", "setMatrix") or genericData(tree) == "assignvar":
+        if tree.children[0] in names: tree.children[0] = names[tree.children[0]]
+    elif tree.data == "vardecl" or tree.data == "foreach":
+        if tree.children[1] in names: tree.children[1] = names[tree.children[1]]
+    for child in tree.children:
+        if isinstance(child, Tree): renameVars(child, names)
+
+class Optimizer(Dispatcher):
+    temps = 0
+
+    def __init__(self, o_env = None, inlineSize = 30, fuse = True, removeFuns = False, tables = True):
+        self.consts = {}
+        self.decls = {}
+        self.assigned = set()
+        self.folder = Evaluator()
+        self.funs = {}
+        self.effects = {}
+        self.inlineSize = inlineSize
+        self.inlinedCalls = []
+        self.funKeys = {}
+        self.memoized = set()
+        self.fuse = fuse
+        self.tables = tables
+        self.removeFuns = removeFuns
+        self.removed = 0
+        self.removedFuns = []
+        self.fusedCounts = {}
+        self.reduced = 0
+        self.switches = 0
+        self.scopes = [0, 0]
+        if o_env != None:
+            self.assigned = assignedNames(getFunTrees(o_env))
+            self.funs = getFuns(o_env)
+
+    def optimize(self, tree):
+        tree = copy.deepcopy(tree)
+        return self.visit(tree)
+
+    def __default__(self, tree):
+        children = tree.children
+        for i in range(len(children)):
+            if isinstance(children[i], Tree): children[i] = self.visit(children[i])
+        return tree
+
+    def start(self, tree):
+        self.assigned |= assignedNames([tree])
+        for (name, decls) in getFunDecls(tree).items():
+            self.funs[name] = self.funs.get(name, []) + decls
+        self.countDecls(tree)
+        statements = []
+        for statement in getStatements(tree.children[0]):
+            for statement in getStatements(self.visit(statement)):
+                self.propagate(statement)
+                statements.append(statement)
+        tree.children[0] = statements[0] if len(statements) == 1 else Tree("program", statements)
+        self.inlineIn(tree, "<top level>")
+        self.memoizeIn(tree)
+        if self.removeFuns: self.removeUnused(tree)
+        if self.fuse: self.fuseIn(tree)
+        self.countScopes(tree)
+        return tree
+
+    def newTemp(self):
+        # Shared between optimizers so temporaries from different runs in
+        # the same session never meet in one scope
+        name = "$%d" % Optimizer.temps
+        Optimizer.temps += 1
+        return name
+
+    def countDecls(self, tree):
+        if tree.data in ("vfundecl", "tfundecl", "stfundecl"): return
+        # Loop variables and hoisted temporaries declare names as well
+        if tree.data == "vardecl" or tree.data == "foreach": name = tree.children[1]
+        elif tree.data == "hoistvar": name = tree.children[0]
+        else: name = None
+        if name is not None: self.decls[name] = self.decls.get(name, 0) + 1
+        for child in tree.children:
+            if isinstance(child, Tree): self.countDecls(child)
+
+    def propagate(self, tree):
+        # Only top level variables that are declared once and never assigned
+        # anywhere (also not by functions from earlier runs) keep their value
+        if tree.data != "vardecl": return
+        (type, name, e) = tree.children
+        if not isConst(e) or name in self.assigned or self.decls.get(name) != 1: return
+        value = e.children[0]
+        if isinstance(value, (bool, int, float, str)): self.consts[name] = value
+
+    def var(self, tree):
+        name = tree.children[0]
+        if name in self.consts: return constTree(self.consts[name])
+        return tree
+
+    def fundecl(self, tree):
+        # Functions see the variables of their caller, so values are not
+        # propagated into their bodies
+        consts = self.consts
+        self.consts = {}
+        self.__default__(tree)
+        self.consts = consts
+        return tree
+
+    vfundecl = tfundecl = stfundecl = fundecl
+
+    def fold(self, tree):
+        self.__default__(tree)
+        for child in tree.children:
+            if isinstance(child, Tree) and not isConst(child): return tree
+        if tree.data == "expexpr" and not self.isSmallPower(tree): return tree
+        try:
+            return constTree(self.folder.visit(tree))
+        except Exception:
+            # Errors like division by zero must happen at run time
+            return tree
+
+    def isSmallPower(self, tree):
+        (e1, e2) = tree.children
+        v1 = e1.children[0]
+        v2 = e2.children[0]
+        return not (type(v1) is int and type(v2) is int and abs(v2) > 64)
+
+    def funEffects(self, name, seen):
+        # (reads, writes, prints, calls) of a call, through its callees as
+        # well. Reads and writes only count variables that are not the
+        # function's own. None means the function is unknown
+        if name in self.effects: return self.effects[name]
+        if name not in self.funs: return None
+        if name in seen: return (set(), set(), False, set())
+        seen.add(name)
+        reads = set()
+        writes = set()
+        prints = False
+        calls = set()
+        for fun in self.funs[name]:
+            (params, body, r) = funParts(fun)
+            declared = set(params)
+            statements = [] if body == None else getStatements(body)
+            if r != None: statements = statements + [r]
+            for statement in statements:
+                (s_reads, s_writes, s_calls) = (set(), set(), set())
+                if scanEffects(statement, s_reads, s_writes, s_calls): prints = True
+                reads |= s_reads - declared
+                writes |= s_writes - declared
+                for callee in s_calls:
+                    effects = self.funEffects(callee, seen)
+                    if effects == None:
+                        seen.discard(name)
+                        return None
+                    reads |= effects[0] - declared
+                    writes |= effects[1] - declared
+                    prints = prints or effects[2]
+                    calls |= effects[3] | {callee}
+                if statement.data == "vardecl": declared.add(statement.children[1])
+        effects = (reads, writes, prints, calls)
+        seen.discard(name)
+        if len(seen) == 0: self.effects[name] = effects
+        return effects
+
+    def funWrites(self, name):
+        effects = self.funEffects(name, set())
+        if effects == None: return None
+        return effects[1]
+
+    def loopWrites(self, trees):
+        names = set()
+        for tree in trees:
+            for node in tree.iter_subtrees():
+                if genericData(node) == "assignvar" or node.data in ("hoistvar", "setentry", "setMatrix"): names.add(node.children[0])
+                elif node.data == "vardecl" or node.data == "foreach": names.add(node.children[1])
+                elif node.data == "runfun":
+                    w = self.funWrites(node.children[0])
+                    if w == None: return None
+                    names |= w
+        return names
+
+    def isInvariant(self, tree, written):
+        # Only expressions that can not fail or have side effects are moved,
+        # since the loop might not run at all
+        if tree.data in ("const", "int", "float", "string", "bool"): return True
+        elif tree.data == "var": return tree.children[0] not in written
+        elif genericData(tree) == "mulexpr" and tree.children[1] != "*": return False
+        elif genericData(tree) not in ("addexpr", "mulexpr", "compexpr", "eqexpr", "notexpr", "andexpr", "orexpr", "size", "tostring", "negative", "list", "tuple", "concatLists"): return False
+        for child in tree.children:
+            if isinstance(child, Tree) and not self.isInvariant(child, written): return False
+        return True
+
+    def hoistFrom(self, tree, written, decls):
+        children = tree.children
+        for i in range(len(children)):
+            child = children[i]
+            if not isinstance(child, Tree) or child.data in ("vfundecl", "tfundecl", "stfundecl"): continue
+            if child.data not in ("const", "int", "float", "string", "bool", "var") and self.isInvariant(child, written):
+                name = self.newTemp()
+                decls.append(Tree("hoistvar", [name, child]))
+                children[i] = Tree("var", [name])
+            else: self.hoistFrom(child, written, decls)
+
+    def hoist(self, tree):
+        self.__default__(tree)
+        # A loop that never runs is dropped, unless a for loop's init calls
+        cond = tree.children[1] if tree.data == "forexpr" else tree.children[0]
+        if tree.data != "foreach" and isConst(cond) and cond.children[0] is False and not (tree.data == "forexpr" and hasCalls(tree.children[0])):
+            self.removed += countNodes(tree)
+            return Tree("program", [])
+        written = self.loopWrites([tree])
+        if written == None: return tree
+        decls = []
+        # The init of a for loop and the list of a for each loop only run once
+        if tree.data == "forexpr": loop = tree.children[1:]
+        elif tree.data == "foreach": loop = tree.children[3:]
+        else: loop = tree.children
+        self.hoistFrom(Tree("loop", loop), written, decls)
+        if len(decls) == 0: return tree
+        return Tree("hoisted", decls + [tree])
+
+    whileexpr = forexpr = foreach = hoist
+
+    def ifexpr(self, tree):
+        self.__default__(tree)
+        # Branches behind constant False conditions are dropped and a
+        # constant True condition ends the chain
+        exprs = tree.children
+        kept = []
+        other = exprs[-1] if len(exprs) % 2 == 1 else None
+        for i in range(0, len(exprs) - 1, 2):
+            cond = exprs[i]
+            if isConst(cond) and cond.children[0] is True:
+                for e in exprs[i+2:]:
+                    self.removed += countNodes(e)
+                self.removed += countNodes(cond)
+                other = exprs[i+1]
+                break
+            elif isConst(cond) and cond.children[0] is False:
+                self.removed += countNodes(cond) + countNodes(exprs[i+1])
+            else: kept += [cond, exprs[i+1]]
+        if len(kept) == 0:
+            if other is None: return Tree("program", [])
+            # The branch keeps its scope when it needs one
+            return Tree("branch", [other]) if declares(other) else other
+        tree.children = kept + ([other] if other is not None else [])
+        # An if/elif chain comparing one expression with constants picks its
+        # branch from a table. The chain is kept for values of other types
+        exprs = tree.children
+        if len(exprs) < 6 or not self.tables: return tree
+        e = None
+        keyType = None
+        table = {}
+        for i in range(0, len(exprs) - 1, 2):
+            cond = exprs[i]
+            if genericData(cond) != "eqexpr" or cond.children[1] != "==": return tree
+            (e1, op, e3) = cond.children
+            if isConst(e1): (e1, e3) = (e3, e1)
+            if not isConst(e3) or isConst(e1) or hasCalls(e1): return tree
+            if e is None: e = e1
+            elif e1 != e: return tree
+            value = e3.children[0]
+            if type(value) not in (int, str): return tree
+            if keyType is None: keyType = type(value)
+            elif type(value) is not keyType: return tree
+            table.setdefault(value, i + 1)
+        other = len(exprs) - 1 if len(exprs) % 2 == 1 else None
+        self.switches += 1
+        return Tree("switch", [copy.deepcopy(e), table, keyType, other, tree])
+
+    def switch(self, tree):
+        return self.visit(tree.children[4])
+
+    def program(self, tree):
+        # Blocks of dropped branches run in the block around them
+        statements = []
+        for statement in tree.children:
+            statements += getStatements(self.visit(statement))
+        tree.children = statements
+        return tree
+
+    def removeUnused(self, tree):
+        # Functions that nothing run from the top level calls. Only for
+        # whole programs, since later input could call them
+        program = tree.children[0]
+        called = set()
+        todo = [s for s in getStatements(program) if s.data not in ("vfundecl", "tfundecl", "stfundecl")]
+        while len(todo) > 0:
+            for node in todo.pop().iter_subtrees():
+                if node.data == "runfun" and node.children[0] not in called:
+                    name = node.children[0]
+                    called.add(name)
+                    for fun in self.funs.get(name, []):
+                        (params, body, r) = funParts(fun)
+                        todo += [t for t in (body, r) if t is not None]
+        statements = []
+        for statement in getStatements(program):
+            if statement.data in ("vfundecl", "tfundecl", "stfundecl"):
+                name = statement.children[0] if statement.data == "vfundecl" else statement.children[1]
+                if name not in called:
+                    self.removedFuns.append(name)
+                    self.removed += countNodes(statement)
+                    continue
+            statements.append(statement)
+        tree.children[0] = statements[0] if len(statements) == 1 else Tree("program", statements)
+
+    def inlineIn(self, tree, context):
+        if tree.data in ("vfundecl", "tfundecl", "stfundecl"):
+            context = tree.children[0] if tree.data == "vfundecl" else tree.children[1]
+        children = tree.children
+        for i in range(len(children)):
+            if not isinstance(children[i], Tree): continue
+            self.inlineIn(children[i], context)
+            if children[i].data == "runfun": children[i] = self.inlineCall(children[i], context)
+
+    def canInline(self, name):
+        # Only functions without prints or writes to outer variables are
+        # inlined, so running their body in the caller's scope can not be
+        # told apart from a call
+        if len(self.funs.get(name, [])) != 1: return False
+        effects = self.funEffects(name, set())
+        if effects == None or effects[1] or effects[2] or name in effects[3]: return False
+        (params, body, r) = funParts(self.funs[name][0])
+        trees = [t for t in (body, r) if t != None]
+        if sum([countNodes(t) for t in trees]) > self.inlineSize: return False
+        locals = set(params)
+        statements = [] if body == None else getStatements(body)
+        for statement in statements:
+            if statement.data == "vardecl":
+                if statement.children[1] in locals: return False
+                locals.add(statement.children[1])
+        for tree in trees:
+            for node in tree.iter_subtrees():
+                if node.data in ("vfundecl", "tfundecl", "stfundecl"): return False
+                elif node.data == "vardecl" and node.children[1] in locals and not any(node is s for s in statements): return False
+                elif node.data == "runfun" or node.data == "inlined":
+                    # Callees would see the function's variables by name
+                    effects = self.funEffects(node.children[0], set())
+                    if effects == None or (effects[0] | effects[1]) & locals: return False
+        return True
+
+    def inlineCall(self, tree, context):
+        (name, args) = tree.children
+        if name == context or not self.canInline(name): return tree
+        fun = self.funs[name][0]
+        (params, body, r) = funParts(fun)
+        key = r if r != None else body
+        names = {}
+        for param in params:
+            names[param] = self.newTemp()
+        if body != None:
+            body = copy.deepcopy(body)
+            for statement in getStatements(body):
+                if statement.data == "vardecl": names[statement.children[1]] = self.newTemp()
+            renameVars(body, names)
+        e = None
+        if r != None:
+            e = copy.deepcopy(r.children[0])
+            renameVars(e, names)
+        temps = [names[param] for param in params]
+        self.inlinedCalls.append((name, context))
+        return Tree("inlined", [name, FunKey(key), tree, temps, list(names.values()), args, body, e])
+
+    def isPure(self, name):
+        # Pure functions only depend on their arguments. Every function
+        # they call must have a single declaration to be sure which one runs
+        if len(self.funs.get(name, [])) != 1: return False
+        effects = self.funEffects(name, set())
+        if effects == None or effects[0] or effects[1] or effects[2]: return False
+        for callee in effects[3]:
+            if len(self.funs.get(callee, [])) != 1: return False
+        return True
+
+    def funKey(self, name):
+        if name not in self.funKeys:
+            (params, body, r) = funParts(self.funs[name][0])
+            self.funKeys[name] = FunKey(body if r is None else r)
+        return self.funKeys[name]
+
+    def memoizeIn(self, tree):
+        children = tree.children
+        for i in range(len(children)):
+            child = children[i]
+            if not isinstance(child, Tree): continue
+            self.memoizeIn(child)
+            # Calls in return position are left to tail call elimination
+            if child.data == "runfun" and tree.data != "returnfun" and self.isPure(child.children[0]):
+                name = child.children[0]
+                deps = [(callee, self.funKey(callee)) for callee in self.funEffects(name, set())[3] | {name}]
+                children[i] = Tree("memocall", [name, child, self.funKey(name), deps])
+                self.memoized.add(name)
+
+    def fuseIn(self, tree):
+        # Goes last, since the other passes only know the nodes it replaces
+        for node in tree.iter_subtrees():
+            name = self.fusedName(node)
+            if name is not None:
+                node.data = name
+                self.fusedCounts[name] = self.fusedCounts.get(name, 0) + 1
+
+    def fusedName(self, tree):
+        def isVar(e):
+            return isinstance(e, Tree) and e.data == "var"
+        if tree.data == "assignvar":
+            (name, e) = tree.children
+            if isinstance(e, Tree) and e.data == "concatLists" and isVar(e.children[0]) and e.children[0].children[0] == name and not hasCalls(e):
+                return "appendVar"
+            if isinstance(e, Tree) and e.data == "mapput" and isVar(e.children[0]) and e.children[0].children[0] == name and not hasCalls(e):
+                return "putVar"
+            if isinstance(e, Tree) and e.data == "setop" and isVar(e.children[1]) and e.children[1].children[0] == name and not hasCalls(e):
+                return "setVar"
+            if not isinstance(e, Tree) or genericData(e) != "addexpr": return None
+            (e1, e2, e3) = e.children
+            if isVar(e1) and e1.children[0] == name:
+                if isConst(e3) and type(e3.children[0]) in (int, float):
+                    return "incVar" if e2 == "+" else "decVar"
+                if e2 == "+" and genericData(e3) == "getentryexpr" and isVar(e3.children[0]) and isVar(e3.children[1]):
+                    return "addEntry"
+            if isVar(e3) and e3.children[0] == name and e2 == "+":
+                if genericData(e1) == "getentryexpr" and isVar(e1.children[0]) and isVar(e1.children[1]):
+                    return "addEntryLeft"
+        elif genericData(tree) == "compexpr" and tree.children[1] == "<" and isVar(tree.children[0]):
+            e3 = tree.children[2]
+            if isVar(e3): return "lessVars"
+            elif isConst(e3) and type(e3.children[0]) in (int, float): return "lessConst"
+            elif e3.data == "size" and isVar(e3.children[0]): return "lessSize"
+        return None
+
+    def countScopes(self, tree):
+        for node in tree.iter_subtrees():
+            for block in blockTrees(node):
+                self.scopes[1] += 1
+                if not declares(block): self.scopes[0] += 1
+
+    def unfuse(self, tree):
+        # Bodies inlined from earlier runs may hold fused nodes, which are
+        # fused again at the end if they still fit
+        tree.data = fusedNodes[tree.data]
+        return self.visit(tree)
+
+    incVar = decVar = addEntry = addEntryLeft = appendVar = putVar = setVar = unfuse
+    lessVars = lessConst = lessSize = unfuse
+
+    def report(self):
+        lines = []
+        for name in sorted(self.memoized):
+            lines.append("Memoizing %s" % name)
+        for (name, context) in self.inlinedCalls:
+            lines.append("Inlined %s in %s" % (name, context))
+        for (name, count) in sorted(self.fusedCounts.items()):
+            lines.append("Fused %d %s" % (count, name))
+        if self.reduced > 0:
+            lines.append("Reduced %d powers and roots" % self.reduced)
+        if self.switches > 0:
+            lines.append("Made %d jump tables" % self.switches)
+        for name in self.removedFuns:
+            lines.append("Removed unused function %s" % name)
+        if self.removed > 0:
+            lines.append("Removed %d dead nodes" % self.removed)
+        if self.scopes[1] > 0:
+            lines.append("Elided %d of %d block scopes" % tuple(self.scopes))
+        return lines
+
+    int = float = string = bool = negative = fold
+    addexpr = mulexpr = divexpr = modexpr = fold
+    eqexpr = compexpr = notexpr = size = tostring = getentryexpr = mapEntry = fold
+    list = tuple = concatLists = addVector = mulVector = reduction = sliceexpr = fold
+    map = mapget = maphas = mapput = mapkeys = set = contains = setop = fold
+    addInts = subInts = addFloats = subFloats = addStrings = fold
+    mulInts = mulFloats = lessInts = lessEqInts = greaterInts = greaterEqInts = fold
+    eqInts = notEqInts = listEntry = fold
+
+    def expexpr(self, tree):
+        tree = self.fold(tree)
+        if tree.data != "expexpr": return tree
+        (e1, e2) = tree.children
+        if isConst(e2) and type(e2.children[0]) is int and 2 <= e2.children[0] <= 4:
+            self.reduced += 1
+            return Tree("power", [e1, e2.children[0]])
+        return tree
+
+    def rootexpr(self, tree):
+        tree = self.fold(tree)
+        if tree.data != "rootexpr": return tree
+        (e1, e2) = tree.children
+        if isConst(e2) and type(e2.children[0]) in (int, float) and e2.children[0] == 2:
+            self.reduced += 1
+            return Tree("sqrt", [e1])
+        return tree
+
+    def andexpr(self, tree):
+        self.__default__(tree)
+        (e1, e2) = tree.children
+        if isConst(e1):
+            if e1.children[0] is False: return constTree(False)
+            elif e1.children[0] is True: return e2
+        return tree
+
+    def orexpr(self, tree):
+        self.__default__(tree)
+        (e1, e2) = tree.children
+        if isConst(e1):
+            if e1.children[0] is True: return constTree(True)
+            elif e1.children[0] is False: return e2
+        return tree
+
+def showConst(value):
+    t = type(value)
+    if t is str or t is Rope: return "\"" + str(value) + "\""
+    elif t is list: return "[" + "; ".join([showConst(v) for v in value]) + "]"
+    elif t is tuple: return "(" + "; ".join([showConst(v) for v in value]) + ")"
+    elif t is ndarray or t is ListView: return showConst(value.tolist())
+    elif t is dict:
+        if len(value) == 0: return "{:}"
+        return "{" + "; ".join(["%s: %s" % (showConst(k), showConst(v)) for (k, v) in value.items()]) + "}"
+    elif t is set: return "{" + "; ".join([showConst(v) for v in sortedValues(value)]) + "}"
+    else: return repr(value)
+
+class CodePrinter(Dispatcher):
+    def __init__(self, indent = ""):
+        self.indent = indent
+
+    def expr(self, tree):
+        # Operators print with parentheses, which are not needed at the
+        # outermost level
+        code = self.visit(tree)
+        if isinstance(tree, Tree) and genericData(tree) in ("eqexpr", "compexpr", "addexpr", "mulexpr", "andexpr", "orexpr", "modexpr", "divexpr", "expexpr", "power", "addVector", "mulVector", "powVector", "concatLists"):
+            return code[1:-1]
+        return code
+
+    def block(self, tree):
+        i_cp = CodePrinter(self.indent + "    ")
+        lines = ""
+        for statement in getStatements(tree):
+            lines += i_cp.indent + i_cp.visit(statement) + ";\n"
+        return "{\n" + lines + self.indent + "}"
+
+    def start(self, tree):
+        lines = ""
+        for statement in getStatements(tree.children[0]):
+            lines += self.visit(statement) + ";\n"
+        return lines
+
+    def type(self, tree):
+        return str(tree.children[0])
+
+    def listtype(self, tree):
+        return self.visit(tree.children[0]) + "[]"
+
+    def tupletype(self, tree):
+        return "(" + "; ".join([self.visit(t) for t in tree.children]) + ")"
+
+    def maptype(self, tree):
+        return "Map(%s; %s)" % (self.visit(tree.children[0]), self.visit(tree.children[1]))
+
+    def settype(self, tree):
+        return "Set(%s)" % self.visit(tree.children[0])
+
+    def vardecl(self, tree):
+        (type, name, e) = tree.children
+        return "%s: %s = %s" % (self.visit(type), name, self.expr(e))
+
+    def assignvar(self, tree):
+        (name, e) = tree.children
+        return "%s = %s" % (name, self.expr(e))
+
+    incVar = decVar = addEntry = addEntryLeft = appendVar = putVar = setVar = assignvar
+
+    def setentry(self, tree):
+        children = tree.children
+        return "%s%s = %s" % (children[0], "".join(["[%s]" % self.expr(e) for e in children[1:-1]]), self.expr(children[-1]))
+
+    setMatrix = setentry
+
+    def funargsdecl(self, tree):
+        return "; ".join([self.visit(arg) for arg in tree.children])
+
+    def funargdecl(self, tree):
+        (type, name) = tree.children
+        return "%s: %s" % (self.visit(type), name)
+
+    def funargs(self, tree):
+        return "; ".join([self.expr(arg) for arg in tree.children])
+
+    def returnfun(self, tree):
+        return "return " + self.expr(tree.children[0])
+
+    def vfundecl(self, tree):
+        (name, args, body) = tree.children
+        return "Void: %s(%s) %s" % (name, self.visit(args), self.block(body))
+
+    def tfundecl(self, tree):
+        (type, name, args, body, r) = tree.children
+        statements = getStatements(body) + [r]
+        return "%s: %s(%s) %s" % (self.visit(type), name, self.visit(args), self.block(Tree("program", statements)))
+
+    def stfundecl(self, tree):
+        (type, name, args, r) = tree.children
+        return "%s: %s(%s) %s" % (self.visit(type), name, self.visit(args), self.block(r))
+
+    def runfun(self, tree):
+        (name, args) = tree.children
+        return "%s(%s)" % (name, self.visit(args))
+
+    def print(self, tree):
+        return "print(%s)" % self.expr(tree.children[0])
+
+    def ifexpr(self, tree):
+        exprs = tree.children
+        code = "if (%s) %s" % (self.expr(exprs[0]), self.block(exprs[1]))
+        i = 2
+        while i < len(exprs)-1:
+            code += " elif (%s) %s" % (self.expr(exprs[i]), self.block(exprs[i+1]))
+            i = i+2
+        if i == len(exprs)-1: code += " else " + self.block(exprs[i])
+        return code
+
+    def switch(self, tree):
+        return "switch " + self.visit(tree.children[4])
+
+    def branch(self, tree):
+        return "if (True) " + self.block(tree.children[0])
+
+    def whileexpr(self, tree):
+        (cond, e) = tree.children
+        return "while (%s) %s" % (self.expr(cond), self.block(e))
+
+    def forexpr(self, tree):
+        (e1, e2, e3, e4) = tree.children
+        return "for (%s; %s; %s) %s" % (self.visit(e1), self.expr(e2), self.visit(e3), self.block(e4))
+
+    def foreach(self, tree):
+        (type, name, e, body) = tree.children
+        return "for (%s: %s in %s) %s" % (self.visit(type), name, self.expr(e), self.block(body))
+
+    def range(self, tree):
+        return "range(%s)" % "; ".join([self.expr(e) for e in tree.children if e is not None])
+
+    def binary(self, tree):
+        (e1, e2, e3) = tree.children
+        return "(%s %s %s)" % (self.visit(e1), e2, self.visit(e3))
+
+    eqexpr = compexpr = addexpr = mulexpr = binary
+    addInts = subInts = addFloats = subFloats = addStrings = binary
+    mulInts = mulFloats = lessInts = lessEqInts = greaterInts = greaterEqInts = binary
+    eqInts = notEqInts = addVector = mulVector = concatLists = binary
+    lessVars = lessConst = lessSize = binary
+
+    def andexpr(self, tree):
+        (e1, e2) = tree.children
+        return "(%s && %s)" % (self.visit(e1), self.visit(e2))
+
+    def orexpr(self, tree):
+        (e1, e2) = tree.children
+        return "(%s || %s)" % (self.visit(e1), self.visit(e2))
+
+    def modexpr(self, tree):
+        (e1, e2) = tree.children
+        return "(%s mod %s)" % (self.visit(e1), self.visit(e2))
+
+    def divexpr(self, tree):
+        (e1, e2) = tree.children
+        return "(%s div %s)" % (self.visit(e1), self.visit(e2))
+
+    def expexpr(self, tree):
+        (e1, e2) = tree.children
+        return "(%s ^ %s)" % (self.visit(e1), self.visit(e2))
+
+    powVector = expexpr
+
+    def getentryexpr(self, tree):
+        (e1, e2) = tree.children
+        return "%s[%s]" % (self.visit(e1), self.expr(e2))
+
+    listEntry = mapEntry = getentryexpr
+
+    def sliceexpr(self, tree):
+        (e1, e2, e3) = tree.children
+        a = "" if e2 is None else self.expr(e2)
+        b = "" if e3 is None else self.expr(e3)
+        return "%s[%s:%s]" % (self.visit(e1), a, b)
+
+    def notexpr(self, tree):
+        return "!" + self.visit(tree.children[0])
+
+    def negative(self, tree):
+        return "-" + self.visit(tree.children[0])
+
+    def rootexpr(self, tree):
+        (e1, e2) = tree.children
+        return "nroot(%s; %s)" % (self.expr(e1), self.expr(e2))
+
+    def power(self, tree):
+        (e, n) = tree.children
+        return "(%s ^ %d)" % (self.visit(e), n)
+
+    def sqrt(self, tree):
+        return "nroot(%s; 2)" % self.expr(tree.children[0])
+
+    def size(self, tree):
+        return "size(%s)" % self.expr(tree.children[0])
+
+    def reduction(self, tree):
+        (name, e) = tree.children
+        return "%s(%s)" % (name, self.expr(e))
+
+    def tostring(self, tree):
+        return "toString(%s)" % self.expr(tree.children[0])
+
+    def list(self, tree):
+        return "[" + "; ".join([self.visit(e) for e in tree.children]) + "]"
+
+    def tuple(self, tree):
+        return "(" + "; ".join([self.visit(e) for e in tree.children]) + ")"
+
+    def map(self, tree):
+        contents = [self.visit(e) for e in tree.children]
+        if len(contents) == 0: return "{:}"
+        return "{" + "; ".join(["%s: %s" % (contents[i], contents[i + 1]) for i in range(0, len(contents), 2)]) + "}"
+
+    def mapget(self, tree):
+        return "get(%s)" % "; ".join([self.expr(e) for e in tree.children])
+
+    def maphas(self, tree):
+        return "has(%s)" % "; ".join([self.expr(e) for e in tree.children])
+
+    def mapput(self, tree):
+        return "put(%s)" % "; ".join([self.expr(e) for e in tree.children])
+
+    def mapkeys(self, tree):
+        return "keys(%s)" % self.expr(tree.children[0])
+
+    def set(self, tree):
+        return "{" + "; ".join([self.visit(e) for e in tree.children]) + "}"
+
+    def contains(self, tree):
+        return "contains(%s)" % "; ".join([self.expr(e) for e in tree.children])
+
+    def setop(self, tree):
+        (name, e1, e2) = tree.children
+        return "%s(%s; %s)" % (name, self.expr(e1), self.expr(e2))
+
+    def call(self, tree):
+        return "%s(%s)" % (builtinNames[tree.data], "; ".join([self.expr(e) for e in tree.children]))
+
+    matrix = matmul = transpose = dot = matrow = matcol = matrows = matcols = call
+
+    def leaf(self, tree):
+        return str(tree.children[0])
+
+    int = float = bool = string = var = leaf
+
+    def const(self, tree):
+        return showConst(tree.children[0])
+
+    def hoisted(self, tree):
+        decls = [self.visit(e) for e in tree.children[:-1]]
+        return "hoist (%s) %s" % ("; ".join(decls), self.visit(tree.children[-1]))
+
+    def hoistvar(self, tree):
+        (name, e) = tree.children
+        return "%s = %s" % (name, self.expr(e))
+
+    def inlined(self, tree):
+        return "inline " + self.visit(tree.children[2])
+
+    def memocall(self, tree):
+        return self.visit(tree.children[1])
+
+def toCode(tree):
+    return CodePrinter().visit(tree)
+
+def runCode(code, tc, ev, dump = False, stats = False, whole = False):
+    # Type errors are found before the optimizer removes any code
+    tree = parser.parse(code)
+    tc.visit(tree)
+    optimizer = Optimizer(ev.env, removeFuns = whole)
+    tree = optimizer.optimize(tree)
+    if dump:
+        print(toCode(tree))
+        for line in optimizer.report():
+            print(line)
+    ev.visit(tree)
+    if stats:
+        for line in ev.rt.report():
+            print(line)
+
+def execute(path, o_tc = TypeChecker(), o_ev = Evaluator(), dump = False, stats = False):
+    with open(path, "r") as file:
+        code = file.read()
+        close
+    i_tc = TypeChecker(o_tc.env)
+    i_ev = Evaluator(o_ev.env, o_ev.rt)
+    runCode(code, i_tc, i_ev, dump, stats, True)
+    o_tc.env.update(i_tc.env)
+    o_ev.env.update(i_ev.env)
+
+# A loop whose conditions guard a call, and the same loop computing both
+# sides of each condition first, as before && and || short-circuited
+guardedLoops = """
+Bool: slow(Int: x) {
+    Int: s = 0;
+    for (Int: k = 0; k < 20; k = k + 1) {
+        s = s + k;
+    };
+    return s > x;
+};
+Int: guarded(Int: n) {
+    Int: hits = 0;
+    for (Int: i = 0; i < n; i = i + 1) {
+        if (((i mod 10) == 0) && slow(i)) {
+            hits = hits + 1;
+        };
+        if (((i mod 10) > 0) || slow(i)) {
+            hits = hits + 1;
+        };
+    };
+    return hits;
+};
+Int: unguarded(Int: n) {
+    Int: hits = 0;
+    for (Int: i = 0; i < n; i = i + 1) {
+        Bool: a = ((i mod 10) == 0);
+        Bool: b = slow(i);
+        if (a && b) {
+            hits = hits + 1;
+        };
+        a = ((i mod 10) > 0);
+        b = slow(i);
+        if (a || b) {
+            hits = hits + 1;
+        };
+    };
+    return hits;
+};
+"""
+
+def benchGuards(n = 20000):
+    # Time of a loop whose && and || guard a call, which runs for one in
+    # ten iterations, and of the same loop calling it every time
+    times = []
+    values = []
+    for name in ("guarded", "unguarded"):
+        tc = TypeChecker()
+        ev = Evaluator()
+        runCode(guardedLoops, tc, ev)
+        start = time.perf_counter()
+        runCode("Int: r = %s(%d);" % (name, n), tc, ev)
+        times.append(time.perf_counter() - start)
+        values.append(ev.env.n_varEnv["r"])
+    same = "the same" if values[0] == values[1] else "different"
+    return ["guarded calls, %d iterations: %.3f s short-circuited, %.3f s evaluating both sides, %s results" % (n, times[0], times[1], same)]
+
+def visitCounts(codes, fuse = True):
+    # How many nodes of each type the Evaluator visits running the programs,
+    # counted by a handler table that wraps each handler. Functions are not
+    # compiled, so that their nodes are counted too
+    counts = {}
+    handlers = Evaluator.handlers
+    def counted(data):
+        f = handlers[data]
+        def g(self, tree):
+            counts[data] = counts.get(data, 0) + 1
+            return f(self, tree)
+        return g
+    class CountingHandlers(Handlers):
+        def __missing__(self, data):
+            g = counted(data)
+            self[data] = g
+            return g
+    Evaluator.handlers = CountingHandlers(Evaluator)
+    try:
+        for code in codes:
+            ev = Evaluator(rt = Runtime(hotCalls = None))
+            try:
+                tree = parser.parse(code)
+                TypeChecker().visit(tree)
+                tree = Optimizer(ev.env, fuse = fuse).optimize(tree)
+                with contextlib.redirect_stdout(io.StringIO()):
+                    ev.visit(tree)
+            except Exception:
+                # Some examples end with the error they show
+                pass
+    finally:
+        Evaluator.handlers = handlers
+    return counts
+
+# The loop of text18.txt: a sum over a list, with the size of the list and
+# a counter
+fusedLoop = """
+Int: s = 0;
+Int: i = 0;
+while (i < size(l)) {
+    s = s + l[i];
+    i = i + 1;
+};
+"""
+
+def benchFusion(n = 10**5, top = 10):
+    # The node types the Evaluator visits most over the example scripts,
+    # with and without fused nodes, and the time of a loop made of the fused
+    # patterns on a list of n ints, fused and not
+    codes = []
+    for path in sorted(glob.glob("text*.txt") + glob.glob("example*.txt")):
+        with open(path, "r") as file:
+            codes.append(file.read())
+    unfused = visitCounts(codes, False)
+    fused = visitCounts(codes, True)
+    total = sum(unfused.values())
+    lines = ["%d scripts: %d nodes visited, %d with fused nodes" % (len(codes), total, sum(fused.values()))]
+    for (data, count) in sorted(unfused.items(), key = lambda item: -item[1])[:top]:
+        lines.append("  %s: %d (%.1f%%)" % (data, count, count * 100.0 / total))
+    for (data, count) in sorted(fused.items(), key = lambda item: -item[1]):
+        if data in fusedNodes: lines.append("  fused %s: %d" % (data, count))
+    times = []
+    values = []
+    for fuse in (True, False):
+        tree = parser.parse(fusedLoop)
+        tc = TypeChecker()
+        ev = Evaluator()
+        tc.env.n_varEnv["l"] = "Int[]"
+        ev.env.n_varEnv["l"] = list(range(n))
+        tc.visit(tree)
+        tree = Optimizer(ev.env, fuse = fuse).optimize(tree)
+        start = time.perf_counter()
+        ev.visit(tree)
+        times.append(time.perf_counter() - start)
+        values.append(ev.env.n_varEnv["s"])
+    same = "the same" if values[0] == values[1] else "different"
+    lines.append("sum loop, %d elements: %.3f s fused, %.3f s unfused, %s results" % (n, times[0], times[1], same))
+    return lines
+
+def stateMachine(states, steps):
+    # A machine of n states, each going to another one and counting how
+    # often the last state was visited
+    arms = []
+    for k in range(states):
+        step = "state = %d;" % ((k * 7 + 3) % states)
+        if k == states - 1: step += " visits = visits + 1;"
+        arms.append("(state == %d) { %s }" % (k, step))
+    return """Int: state = 0;
+Int: visits = 0;
+for (Int: i = 0; i < %d; i = i + 1) {
+    if %s;
+};
+""" % (steps, "\n    elif ".join(arms))
+
+def benchSwitch(states = 50, steps = 20000):
+    # Time of a state machine written as an if/elif chain, with the chain
+    # made a jump table and evaluated in order
+    times = []
+    values = []
+    for tables in (True, False):
+        tree = parser.parse(stateMachine(states, steps))
+        ev = Evaluator()
+        TypeChecker().visit(tree)
+        tree = Optimizer(ev.env, tables = tables).optimize(tree)
+        start = time.perf_counter()
+        ev.visit(tree)
+        times.append(time.perf_counter() - start)
+        values.append((ev.env.n_varEnv["state"], ev.env.n_varEnv["visits"]))
+    same = "the same" if values[0] == values[1] else "different"
+    return ["%d-state machine, %d steps: %.3f s with a jump table, %.3f s in order, %s results" % (states, steps, times[0], times[1], same)]
+
+def sumTree(depth):
+    if depth == 0: return Tree("int", [Token("INT", "1")])
+    return Tree("addexpr", [sumTree(depth - 1), Token("ADDOP", "+"), sumTree(depth - 1)])
+
+def benchDispatch(depth = 12, rounds = 20):
+    # Time per node of checking and evaluating a sum, with handlers looked
+    # up by Interpreter and taken from the handler table
+    class LookupTypeChecker(TypeChecker):
+        visit = _visit_tree = Interpreter._visit_tree
+
+    class LookupEvaluator(Evaluator):
+        visit = _visit_tree = Interpreter._visit_tree
+
+    lines = []
+    for (name, lookup, table) in [("TypeChecker", LookupTypeChecker, TypeChecker), ("Evaluator", LookupEvaluator, Evaluator)]:
+        times = []
+        for cls in (lookup, table):
+            tree = sumTree(depth)
+            nodes = countNodes(tree)
+            visitor = cls()
+            visitor.visit(tree)
+            best = None
+            for i in range(rounds):
+                start = time.perf_counter()
+                visitor.visit(tree)
+                t = (time.perf_counter() - start) / nodes
+                if best == None or t < best: best = t
+            times.append(best * 1e9)
+        lines.append("%s: %.0f ns per node by name, %.0f ns from the table, %.0f ns saved" % (name, times[0], times[1], times[0] - times[1]))
+    return lines
+
+def benchVector(sizes = (10**3, 10**4, 10**5, 10**6, 10**7)):
+    # Time of an operator between a list of n numbers and a number, done for
+    # each number by Python, on the list, which becomes an array first, and
+    # on the array
+    if numpy is None: return ["NumPy is not installed"]
+    lines = []
+    for n in sizes:
+        for (op, l, s) in [("*", list(range(n)), 3), ("/", [x * 0.5 for x in range(n)], 4.0)]:
+            a = numbers(l)
+            f = vectorOps[op]
+            times = []
+            for g in (lambda: [f(x, s) for x in l], lambda: vectorValue(op, l, s), lambda: vectorValue(op, a, s)):
+                best = None
+                for i in range(max(3, min(100, 10**6 // n))):
+                    start = time.perf_counter()
+                    g()
+                    t = time.perf_counter() - start
+                    if best == None or t < best: best = t
+                times.append(best * 1e3)
+            lines.append("%s[] %s %s, %d elements: %.3f ms in Python, %.3f ms from a list, %.3f ms on an array" % (type(s).__name__.capitalize(), op, s, n, times[0], times[1], times[2]))
+    return lines
+
+# The reductions of example1.txt, written with loops over the list
+loopReductions = """
+Float: sum(Float[]: list){
+    Float: sum = 0;
+    for(Int: i = 0; i < size(list); i = i+1){
+        sum = list[i] + sum;
+    };
+    return sum;
+};
+
+Float: average(Float[]: list){
+    Float: avg = 0;
+    Int: n = size(list);
+    if (n > 0) {
+        avg = sum(list)/n;
+    };
+    return avg;
+};
+
+Float: sDeviation(Float[]: list){
+    Int: n = size(list);
+    Float: sum = 0;
+    Float: avg = average(list);
+    for(Int: i = 0; i < size(list); i = i+1){
+        sum = sum + (list[i] - avg)^2;
+    };
+    return nroot((sum/(n-1)); 2);
+};
+"""
+
+def benchReductions(n = 10**6):
+    # Time of the reductions of example1.txt and of the builtins on a list
+    # of n floats, and of the builtins on it as an array
+    l = [(i % 1000) * 0.25 for i in range(n)]
+    lines = []
+    for (loop, builtin) in [("sum", "sum"), ("average", "mean"), ("sDeviation", "stddev")]:
+        times = []
+        values = []
+        for (code, value) in [(loopReductions, l), ("", l), ("", numbers(l) if numpy is not None else l)]:
+            tc = TypeChecker()
+            ev = Evaluator()
+            if code: runCode(code, tc, ev)
+            tc.env.n_varEnv["l"] = "Float[]"
+            ev.env.n_varEnv["l"] = value
+            start = time.perf_counter()
+            runCode("Float: r = %s(l);" % (loop if code else builtin), tc, ev)
+            times.append(time.perf_counter() - start)
+            values.append(ev.env.n_varEnv["r"])
+        same = "the same" if values[0] == values[1] == values[2] else "different"
+        lines.append("%s and %s, %d elements: %.3f s with a loop, %.4f s on a list, %.4f s on an array, %s results" % (loop, builtin, n, times[0], times[1], times[2], same))
+    return lines
+
+def benchAppend(sizes = (10**4, 10**5, 10**6), copyUpTo = 10**5):
+    # Time of building a list of n ints with x = x + [i] in a loop, in place
+    # and, for the sizes it is quick enough for, by copying the list
+    lines = []
+    for n in sizes:
+        times = []
+        for fuse in (True, False):
+            if not fuse and n > copyUpTo:
+                times.append(None)
+                continue
+            tree = parser.parse("Int[]: x = []; for (Int: i = 0; i < %d; i = i + 1) { x = x + [i]; };" % n)
+            ev = Evaluator()
+            TypeChecker().visit(tree)
+            tree = Optimizer(ev.env, fuse = fuse).optimize(tree)
+            start = time.perf_counter()
+            ev.visit(tree)
+            times.append(time.perf_counter() - start)
+        copied = "%.3f s copying" % times[1] if times[1] != None else "copying not timed"
+        lines.append("x = x + [i], %d elements: %.3f s in place, %s" % (n, times[0], copied))
+    return lines
+
+def benchRecursiveAppend(depths = (2000, 4000, 8000)):
+    # Time of appending to a global list from each of n nested calls, which
+    # all share the variable
+    lines = []
+    for n in depths:
+        tc = TypeChecker()
+        ev = Evaluator()
+        runCode("Int[]: x = []; Void: fill(Int: n) { if (n > 0) { x = x + [n]; fill(n - 1); }; };", tc, ev)
+        start = time.perf_counter()
+        runCode("fill(%d);" % n, tc, ev)
+        t = time.perf_counter() - start
+        lines.append("x = x + [n] from %d nested calls: %.3f s, %.1f us per call" % (n, t, t / n * 1e6))
+    return lines
+
+mergeSorts = """Int[]: merge(Int[]: a; Int[]: b) {
+    Int[]: out = [];
+    Int: i = 0;
+    Int: j = 0;
+    while ((i < size(a)) && (j < size(b))) {
+        Int: x = a[i];
+        Int: y = b[j];
+        if (x <= y) {
+            out = out + [x];
+            i = i + 1;
+        }
+        else {
+            out = out + [y];
+            j = j + 1;
+        };
+    };
+    return (out + a[i:]) + b[j:];
+};
+Int[]: msort(Int[]: l) {
+    Int[]: sorted = l;
+    if (size(l) > 1) {
+        Int: m = (size(l) div 2);
+        sorted = merge(msort(l[:m]); msort(l[m:]));
+    };
+    return sorted;
+};
+Int[]: part(Int[]: l; Int: a; Int: b) {
+    Int[]: out = [];
+    for (Int: i = a; i < b; i = i + 1) {
+        Int: x = l[i];
+        out = out + [x];
+    };
+    return out;
+};
+Int[]: msortCopy(Int[]: l) {
+    Int[]: sorted = l;
+    if (size(l) > 1) {
+        Int: m = (size(l) div 2);
+        sorted = merge(msortCopy(part(l; 0; m)); msortCopy(part(l; m; size(l))));
+    };
+    return sorted;
+};
+"""
+
+def benchSlices(sizes = (10**3, 10**4)):
+    # Time of merge sort on n ints with the halves as slices, and with the
+    # halves copied by a loop
+    lines = []
+    for n in sizes:
+        times = []
+        values = []
+        for sort in ("msort", "msortCopy"):
+            tc = TypeChecker()
+            ev = Evaluator()
+            runCode(mergeSorts, tc, ev)
+            tc.env.n_varEnv["l"] = "Int[]"
+            ev.env.n_varEnv["l"] = [(i * 7919) % n for i in range(n)]
+            start = time.perf_counter()
+            runCode("Int[]: r = %s(l);" % sort, tc, ev)
+            times.append(time.perf_counter() - start)
+            values.append(ev.env.n_varEnv["r"])
+        same = "the same" if values[0] == values[1] else "different"
+        lines.append("merge sort, %d elements: %.3f s with slices, %.3f s copying halves, %s results" % (n, times[0], times[1], same))
+    return lines
+
+lookups = """
+Int: mapLookups(Int[]: ks; Int[]: vs; Int[]: qs) {
+    Map(Int; Int): m = {:};
+    for (Int: i = 0; i < size(ks); i = i + 1) {
+        Int: k = ks[i];
+        Int: v = vs[i];
+        m = put(m; k; v);
+    };
+    Int: total = 0;
+    for (Int: i = 0; i < size(qs); i = i + 1) {
+        Int: q = qs[i];
+        total = total + get(m; q);
+    };
+    return total;
+};
+Int: scanLookups(Int[]: ks; Int[]: vs; Int[]: qs) {
+    Int: total = 0;
+    for (Int: i = 0; i < size(qs); i = i + 1) {
+        Int: j = 0;
+        while (ks[j] != qs[i]) {
+            j = j + 1;
+        };
+        total = total + vs[j];
+    };
+    return total;
+};
+"""
+
+def benchMaps(sizes = (10**2, 10**3)):
+    # Time of n lookups in a table of n ints, in a map and by scanning
+    # parallel lists of keys and values
+    lines = []
+    for n in sizes:
+        times = []
+        values = []
+        for lookup in ("mapLookups", "scanLookups"):
+            tc = TypeChecker()
+            ev = Evaluator()
+            runCode(lookups, tc, ev)
+            for (name, value) in [("ks", [(i * 7919) % n for i in range(n)]), ("vs", list(range(n))), ("qs", [(i * 31) % n for i in range(n)])]:
+                tc.env.n_varEnv[name] = "Int[]"
+                ev.env.n_varEnv[name] = value
+            start = time.perf_counter()
+            runCode("Int: r = %s(ks; vs; qs);" % lookup, tc, ev)
+            times.append(time.perf_counter() - start)
+            values.append(ev.env.n_varEnv["r"])
+        same = "the same" if values[0] == values[1] else "different"
+        lines.append("lookups, %d keys: %.3f s in a map, %.3f s scanning lists, %s results" % (n, times[0], times[1], same))
+    return lines
+
+dedupes = """
+Int[]: setDedupe(Int[]: l) {
+    Set(Int): seen = {};
+    Int[]: out = [];
+    for (Int: i = 0; i < size(l); i = i + 1) {
+        Int: x = l[i];
+        if (!contains(seen; x)) {
+            seen = union(seen; {x});
+            out = out + [x];
+        };
+    };
+    return out;
+};
+Int[]: scanDedupe(Int[]: l) {
+    Int[]: out = [];
+    for (Int: i = 0; i < size(l); i = i + 1) {
+        Int: x = l[i];
+        Int: j = 0;
+        while ((j < size(out)) && (out[j] != x)) {
+            j = j + 1;
+        };
+        if (j == size(out)) {
+            out = out + [x];
+        };
+    };
+    return out;
+};
+Int: setJoin(Int[]: a; Int[]: b) {
+    Set(Int): sa = {};
+    for (Int: i = 0; i < size(a); i = i + 1) {
+        Int: x = a[i];
+        sa = union(sa; {x});
+    };
+    Set(Int): sb = {};
+    for (Int: i = 0; i < size(b); i = i + 1) {
+        Int: x = b[i];
+        sb = union(sb; {x});
+    };
+    return size(intersection(sa; sb));
+};
+Int: scanJoin(Int[]: a; Int[]: b) {
+    Int: n = 0;
+    for (Int: i = 0; i < size(a); i = i + 1) {
+        Int: j = 0;
+        while ((j < size(b)) && (b[j] != a[i])) {
+            j = j + 1;
+        };
+        if (j < size(b)) {
+            n = n + 1;
+        };
+    };
+    return n;
+};
+"""
+
+def benchSets(sizes = (10**2, 10**3)):
+    # Time of removing the repeats from n ints and of counting the ints two
+    # lists of n distinct ints share, with sets and by scanning lists
+    lines = []
+    for n in sizes:
+        for (work, calls) in [("dedupe", ("Int[]: r = setDedupe(a);", "Int[]: r = scanDedupe(a);")), ("join", ("Int: r = setJoin(a; b);", "Int: r = scanJoin(a; b);"))]:
+            times = []
+            values = []
+            for call in calls:
+                tc = TypeChecker()
+                ev = Evaluator()
+                runCode(dedupes, tc, ev)
+                a = [(i * 7919) % (n // 2) for i in range(n)] if work == "dedupe" else list(range(n))
+                for (name, value) in [("a", a), ("b", [i * 3 for i in range(n)])]:
+                    tc.env.n_varEnv[name] = "Int[]"
+                    ev.env.n_varEnv[name] = value
+                start = time.perf_counter()
+                runCode(call, tc, ev)
+                times.append(time.perf_counter() - start)
+                values.append(ev.env.n_varEnv["r"])
+            same = "the same" if values[0] == values[1] else "different"
+            lines.append("%s, %d ints: %.3f s with sets, %.3f s scanning lists, %s results" % (work, n, times[0], times[1], same))
+    return lines
+
+eachReductions = """
+Float: sumEach(Float[]: list){
+    Float: sum = 0;
+    for(Float: x in list){
+        sum = x + sum;
+    };
+    return sum;
+};
+
+Float: sDeviationEach(Float[]: list){
+    Int: n = size(list);
+    Float: sum = 0;
+    Float: avg = sumEach(list) / n;
+    for(Float: x in list){
+        sum = sum + (x - avg)^2;
+    };
+    return nroot((sum/(n-1)); 2);
+};
+
+Int: countTo(Int: n){
+    Int: total = 0;
+    for(Int: i = 0; i < n; i = i+1){
+        total = total + i;
+    };
+    return total;
+};
+
+Int: countRange(Int: n){
+    Int: total = 0;
+    for(Int: i in range(0; n)){
+        total = total + i;
+    };
+    return total;
+};
+"""
+
+def benchForEach(n = 10**6):
+    # Time of the index loops of example1.txt over a list of n floats and
+    # of counting to n, against the same loops written with for each
+    l = [(i % 1000) * 0.25 for i in range(n)]
+    lines = []
+    for (loop, each) in [("sum", "sumEach"), ("sDeviation", "sDeviationEach"), ("countTo", "countRange")]:
+        times = []
+        values = []
+        for name in (loop, each):
+            tc = TypeChecker()
+            ev = Evaluator()
+            runCode(loopReductions + eachReductions, tc, ev)
+            tc.env.n_varEnv["l"] = "Float[]"
+            ev.env.n_varEnv["l"] = l
+            call = "Int: r = %s(%d);" % (name, n) if loop == "countTo" else "Float: r = %s(l);" % name
+            start = time.perf_counter()
+            runCode(call, tc, ev)
+            times.append(time.perf_counter() - start)
+            values.append(ev.env.n_varEnv["r"])
+        same = "the same" if values[0] == values[1] else "different"
+        lines.append("%s and %s, %d elements: %.3f s with an index loop, %.3f s with for each, %s results" % (loop, each, n, times[0], times[1], same))
+    return lines
+
+matmulLoop = """
+Float[][]: matmulLoop(Float[][]: a; Float[][]: b) {
+    Float[][]: c = [];
+    for (Int: i = 0; i < size(a); i = i + 1) {
+        Float[]: ai = a[i];
+        Float[]: row = [];
+        for (Int: j = 0; j < size(b[0]); j = j + 1) {
+            Float: s = 0.0;
+            for (Int: k = 0; k < size(b); k = k + 1) {
+                Float[]: bk = b[k];
+                s = s + (ai[k] * bk[j]);
+            };
+            row = row + [s];
+        };
+        c = c + [row];
+    };
+    return c;
+};
+"""
+
+def benchMatrix(sizes = (25, 50, 100, 200), loopUpTo = 100):
+    # Time of multiplying two n by n matrices with loops over Float[][] and
+    # with matmul, and the largest difference between their entries
+    lines = []
+    for n in sizes:
+        a = [[((i * n + j) % 7) * 0.5 for j in range(n)] for i in range(n)]
+        b = [[((i + 2 * j) % 5) * 0.25 for j in range(n)] for i in range(n)]
+        times = []
+        values = []
+        for code in ("Float[][]: r = matmulLoop(a; b);", "Matrix: r = matmul(matrix(a); matrix(b));"):
+            if code[0] == "F" and n > loopUpTo:
+                times.append(None)
+                continue
+            tc = TypeChecker()
+            ev = Evaluator()
+            runCode(matmulLoop, tc, ev)
+            for (name, value) in [("a", a), ("b", b)]:
+                tc.env.n_varEnv[name] = "Float[][]"
+                ev.env.n_varEnv[name] = value
+            start = time.perf_counter()
+            runCode(code, tc, ev)
+            times.append(time.perf_counter() - start)
+            values.append(outValue(ev.env.n_varEnv["r"]))
+        if times[0] is None:
+            lines.append("matmul, %dx%d: loops not timed, %.4f s with matmul" % (n, n, times[1]))
+            continue
+        diff = max([abs(x - y) for (r1, r2) in zip(values[0], values[1]) for (x, y) in zip(r1, r2)])
+        lines.append("matmul, %dx%d: %.3f s with loops, %.4f s with matmul, entries differ by at most %g" % (n, n, times[0], times[1], diff))
+    return lines
+
+coinChanges = """
+Int: waysInPlace(Int[]: coins; Int: n) {
+    Int[]: ways = [1];
+    for (Int: j in range(0; n)) {
+        ways = ways + [0];
+    };
+    for (Int: c in coins) {
+        for (Int: j in range(c; n + 1)) {
+            ways[j] = ways[j] + ways[j - c];
+        };
+    };
+    return ways[n];
+};
+Int[]: setAt(Int[]: l; Int: i; Int: v) {
+    return (l[:i] + [v]) + l[i + 1:];
+};
+Int: waysRebuilt(Int[]: coins; Int: n) {
+    Int[]: ways = [1];
+    for (Int: j in range(0; n)) {
+        ways = ways + [0];
+    };
+    for (Int: c in coins) {
+        for (Int: j in range(c; n + 1)) {
+            Int: w = ways[j] + ways[j - c];
+            ways = setAt(ways; j; w);
+        };
+    };
+    return ways[n];
+};
+"""
+
+def benchEntries(sizes = (10**3, 10**4)):
+    # Time of counting the ways to pay n with a table of n ints, setting its
+    # entries in place and rebuilding it for every entry
+    lines = []
+    for n in sizes:
+        times = []
+        values = []
+        for name in ("waysInPlace", "waysRebuilt"):
+            tc = TypeChecker()
+            ev = Evaluator()
+            runCode(coinChanges, tc, ev)
+            start = time.perf_counter()
+            runCode("Int: r = %s([1; 2; 5; 10; 25]; %d);" % (name, n), tc, ev)
+            times.append(time.perf_counter() - start)
+            values.append(ev.env.n_varEnv["r"])
+        same = "the same" if values[0] == values[1] else "different"
+        lines.append("coin change, %d entries: %.3f s in place, %.3f s rebuilding, %s results" % (n, times[0], times[1], same))
+    return lines
+
+if __name__ == '__main__':
+    if "--bench" in sys.argv:
+        for line in benchGuards() + benchFusion() + benchSwitch() + benchDispatch() + benchVector() + benchReductions() + benchAppend() + benchRecursiveAppend() + benchSlices() + benchMaps() + benchSets() + benchForEach() + benchMatrix() + benchEntries():
+            print(line)
+        sys.exit()
+    tc = TypeChecker()
+    ev = Evaluator()
+    dump = "--dump" in sys.argv
+    stats = "--stats" in sys.argv
+    while True:
+        code = input('> ')
+        if code.strip() == "quit()":
+            break
+        try:
+            runCode(code, tc, ev, dump, stats)
         except Exception as e:
             print(e)